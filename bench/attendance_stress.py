@@ -0,0 +1,74 @@
+"""Concurrency stress test for set_attendance.
+
+Many threads change attendance on one event at the same time, each thread
+owning a distinct set of users. Afterwards every user must appear exactly
+once, under the status its thread set last. Prints a JSON summary and exits
+non-zero if any change was lost.
+
+Runs against mongomock by default. Pass --uri to run against a real server
+(a scratch database is created and dropped).
+
+    python bench/attendance_stress.py --threads 32 --users 256 --changes 8
+"""
+import argparse, random, sys, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from common import load_eventbot, dump, User
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--users', type=int, default=256)
+    parser.add_argument('--changes', type=int, default=8, help='status changes per user')
+    parser.add_argument('--uri', help='mongodb uri of a real server to use instead of mongomock')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    eventbot = load_eventbot()
+    if args.uri:
+        database = common.REAL_MONGO_CLIENT(args.uri)['eventbot_stress_' + uuid.uuid4().hex[:8]]
+    else:
+        database = eventbot.db
+    collection = database['1']
+
+    event = {'Name': 'stress', 'Metadata': {'Reminders': {}, 'GuildID': 1}}
+    for status in eventbot.STATUSES:
+        event[status] = []
+    collection.insert_one(event)
+
+    statuses = list(eventbot.STATUSES)
+    rng = random.Random(args.seed)
+    users = [User(i) for i in range(args.users)]
+    plans = {user.id: [rng.choice(statuses) for _ in range(args.changes)] for user in users}
+    shards = [users[i::args.threads] for i in range(args.threads)]
+
+    def run(shard):
+        # Interleave this thread's users so writes to the event overlap as much as possible
+        for step in range(args.changes):
+            for user in shard:
+                eventbot.set_attendance('stress', user, plans[user.id][step], collection)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(run, shards))
+
+    final = collection.find_one({'Name': 'stress'})
+    lost, duplicated = 0, 0
+    for user in users:
+        found = [status for status in statuses for entry in final[status] if entry['ID'] == user.id]
+        if found != [plans[user.id][-1]]:
+            lost += 1
+        duplicated += max(0, len(found) - 1)
+
+    if args.uri:
+        database.client.drop_database(database.name)
+
+    dump({'threads': args.threads, 'users': args.users, 'changes': args.users * args.changes,
+          'wrong_status': lost, 'duplicated': duplicated,
+          'backend': 'mongodb' if args.uri else 'mongomock'})
+    return 1 if lost or duplicated else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""Shared setup for the eventbot benchmarks.
+
+Loads eventbot against an in-memory mongomock database and provides the fake
+discord objects the helpers and commands expect, so nothing talks to the network.
+"""
+import os, sys, threading, time, warnings, collections, json, logging, itertools, asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Collection methods which cost a round trip against a real server
+DB_METHODS = ('find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many',
+              'replace_one', 'delete_one', 'delete_many', 'remove', 'find_one_and_update',
+              'bulk_write', 'count_documents', 'distinct', 'aggregate', 'create_index')
+
+
+# pymongo.MongoClient before load_eventbot swaps it for mongomock
+REAL_MONGO_CLIENT = None
+
+
+def load_eventbot():
+    global REAL_MONGO_CLIENT
+    import mongomock, pymongo
+    warnings.simplefilter('ignore')
+    if REAL_MONGO_CLIENT is None:
+        REAL_MONGO_CLIENT = pymongo.MongoClient
+    for var in ('BOT_TOKEN', 'MONGOUSER', 'MONGOPASS'):
+        os.environ.setdefault(var, 'benchmark')
+    pymongo.MongoClient = mongomock.MongoClient
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import eventbot
+    logging.disable(logging.INFO) # per-command log lines would dominate the timings
+    return eventbot
+
+
+class DBProbe:
+    """Counts Mongo operations and optionally adds latency to each one."""
+
+    def __init__(self):
+        self.latency = 0.0
+        self.ops = collections.Counter()
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+
+    def install(self):
+        from mongomock.collection import Collection
+        for name in DB_METHODS:
+            original = getattr(Collection, name, None)
+            if original is not None:
+                setattr(Collection, name, self._wrap(name, original))
+        return self
+
+    def _wrap(self, name, original):
+        probe = self
+
+        def wrapper(*args, **kwargs):
+            depth = getattr(probe._depth, 'value', 0)
+            if depth == 0: # mongomock calls its own methods internally, count the outermost only
+                with probe._lock:
+                    probe.ops[name] += 1
+                if probe.latency:
+                    time.sleep(probe.latency)
+            probe._depth.value = depth + 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                probe._depth.value = depth
+        return wrapper
+
+    def reset(self):
+        with self._lock:
+            self.ops.clear()
+
+    def total(self):
+        return sum(self.ops.values())
+
+
+class Role:
+    def __init__(self, position):
+        self.position = position
+        self.name = 'role{}'.format(position)
+
+
+class User:
+    def __init__(self, id, name=None, discriminator='0001'):
+        self.id = id
+        self.name = name or 'user{}'.format(id)
+        self.discriminator = discriminator
+        self.roles = [Role(0)]
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class Guild:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name or 'guild{}'.format(id)
+        self.roles = [Role(0), Role(1)]
+
+
+class Message:
+    ids = itertools.count(1000)
+
+    def __init__(self, author, guild, content=''):
+        self.id = next(Message.ids)
+        self.author = author
+        self.guild = guild
+        self.content = content
+
+
+class Context:
+    def __init__(self, guild, author, content=''):
+        self.message = Message(author, guild, content)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+        return Message(None, self.message.guild, content)
+
+
+async def heartbeat(lags, stop, interval=0.01):
+    """Append how late each interval-second sleep wakes up until stop is set."""
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {'p{}'.format(p): None for p in points}
+    ordered = sorted(samples)
+    result = {}
+    for p in points:
+        index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        result['p{}'.format(p)] = ordered[index]
+    return result
+
+
+def dump(result):
+    print(json.dumps(result, sort_keys=True))
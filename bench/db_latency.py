@@ -0,0 +1,69 @@
+"""Command latency and event loop lag while Mongo is slow.
+
+Fires bursts of concurrent !show commands with an artificial delay added to every
+Mongo call. Each burst runs twice: once with helpers called inline inside the
+coroutine (how eventbot worked before run_db) and once through eventbot.run_db.
+Prints one JSON object per run.
+
+    python bench/db_latency.py --concurrency 32 --latency 0 0.005 0.02 0.05
+"""
+import argparse, asyncio, time
+
+from common import load_eventbot, DBProbe, Guild, User, Context, heartbeat, percentiles, dump
+
+
+async def call_inline(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+async def burst(eventbot, guild, concurrency):
+    # Every command in the burst arrives at the same moment, so latency is
+    # measured from the start of the burst and includes time spent queued
+    latencies = []
+
+    async def one(i):
+        ctx = Context(guild, User(i), '!show bench')
+        await eventbot.show.callback(ctx, name='bench')
+        latencies.append(time.perf_counter() - start)
+
+    lags = []
+    stop = asyncio.Event()
+    beat = asyncio.ensure_future(heartbeat(lags, stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    return latencies, lags, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0, 0.005, 0.02, 0.05],
+                        help='seconds added to every Mongo call')
+    args = parser.parse_args()
+
+    eventbot = load_eventbot()
+    probe = DBProbe().install()
+    guild = Guild(1)
+    eventbot.new_event(Context(guild, User(0)), 'bench', 'tomorrow 8pm')
+    run_db = eventbot.run_db
+    loop = eventbot.bot.loop
+
+    for latency in args.latency:
+        probe.latency = latency
+        for mode, dispatch in (('inline', call_inline), ('run_db', run_db)):
+            eventbot.run_db = dispatch
+            latencies, lags, elapsed = loop.run_until_complete(burst(eventbot, guild, args.concurrency))
+            result = {'mode': mode, 'db_latency': latency, 'concurrency': args.concurrency,
+                      'db_workers': eventbot.DB_CONCURRENCY, 'elapsed': elapsed,
+                      'max_loop_lag': max(lags) if lags else None}
+            result.update({'latency_' + k: v for k, v in percentiles(latencies).items()})
+            dump(result)
+    eventbot.run_db = run_db
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Speed of input_to_datetime against the dateparser-only version it replaced.
+
+Times the old function (dateparser.parse, then localize), the fast parser with
+its cache cleared before every call, and the cached path, over a mix of typical
+!schedule inputs. Also checks that the fast parser agrees with dateparser on
+every input, and times importing dateparser in a fresh interpreter.
+Prints one JSON object per case.
+
+    python bench/parse_datetime.py --repeat 2000
+"""
+import argparse, datetime, subprocess, sys, time
+
+from common import load_eventbot, percentiles, dump
+
+INPUTS = ['3/14 1:00PM', '10/5 8:00 pm', '12/31/2027 9pm', 'today 8pm', 'tomorrow 13:30',
+          'TOMORROW 8PM', '8pm', '9:15am', '1/2 12am', 'today 12:30am']
+# Not handled by the fast parser, these still go to dateparser
+FALLBACK_INPUTS = ['tomorrow at 8pm', 'March 14 2027 1pm', 'in 2 days']
+
+
+def old_input_to_datetime(inp, tz):
+    from dateparser import parse
+    time = parse(inp)
+    if time.tzinfo is None:
+        time = tz.localize(time)
+    return time
+
+
+def measure(func, inputs, repeat, before=None):
+    samples = []
+    for i in range(repeat):
+        inp = inputs[i % len(inputs)]
+        if before:
+            before()
+        start = time.perf_counter()
+        func(inp)
+        samples.append(time.perf_counter() - start)
+    return dict(percentiles([s * 1e6 for s in samples]), calls_per_sec=round(len(samples) / sum(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import dateparser'])
+    interpreter = time.perf_counter() - start
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'pass'])
+    interpreter_only = time.perf_counter() - start
+    dump({'case': 'import_dateparser', 'seconds': round(interpreter - interpreter_only, 3)})
+
+    eventbot = load_eventbot()
+    tz = eventbot.DEFAULT_TZ
+    today = datetime.date.today()
+
+    mismatches = [inp for inp in INPUTS if eventbot.input_to_datetime(inp, tz) != old_input_to_datetime(inp, tz)]
+    unhandled = [inp for inp in INPUTS if eventbot.fast_parse_datetime(inp, today) is None]
+    dump({'case': 'agreement', 'inputs': len(INPUTS), 'mismatches': mismatches, 'not_fast_parsed': unhandled})
+
+    cases = [
+        ('dateparser', INPUTS, lambda inp: old_input_to_datetime(inp, tz), None),
+        ('fast_uncached', INPUTS, lambda inp: eventbot.input_to_datetime(inp, tz), eventbot.parse_datetime.cache_clear),
+        ('fast_cached', INPUTS, lambda inp: eventbot.input_to_datetime(inp, tz), None),
+        ('fallback_uncached', FALLBACK_INPUTS, lambda inp: eventbot.input_to_datetime(inp, tz), eventbot.parse_datetime.cache_clear),
+    ]
+    for name, inputs, func, before in cases:
+        func(inputs[0]) # warm up imports
+        result = measure(func, inputs, args.repeat, before)
+        result.update(case=name, unit='us')
+        dump(result)
+
+
+if __name__ == '__main__':
+    main()
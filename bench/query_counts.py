@@ -0,0 +1,118 @@
+"""Mongo operations issued by each command.
+
+Runs every command once against mongomock and prints the number of Mongo
+operations it issued, broken down by collection method. Server config is
+cached before measuring, so the counts are steady state.
+
+    python bench/query_counts.py [--events 10]
+"""
+import argparse
+
+from common import load_eventbot, DBProbe, Guild, User, Context, dump
+
+
+class Reaction:
+    def __init__(self, emoji):
+        self.emoji = emoji
+
+
+class ReactionMessage:
+    def __init__(self, id, content, emoji):
+        self.id = id
+        self.content = content
+        self.reactions = [Reaction(emoji)]
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def clear_reactions(self):
+        self.reactions = []
+
+
+class Channel:
+    def __init__(self, id):
+        self.id = id
+        self.messages = {}
+
+    async def get_message(self, id):
+        return self.messages[id]
+
+    async def send(self, content=None, **kwargs):
+        return ReactionMessage(0, content, None)
+
+
+class Payload:
+    def __init__(self, guild_id, channel_id, message_id, user_id, emoji):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.emoji = emoji
+
+
+async def call_inline(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=10, help='events in the guild for !show_all')
+    args = parser.parse_args()
+
+    eventbot = load_eventbot()
+    eventbot.run_db = call_inline
+    probe = DBProbe().install()
+    loop = eventbot.bot.loop
+
+    guild, other_guild = Guild(1), Guild(2)
+    author = User(1, 'author')
+    channel = Channel(10)
+    guild.get_channel = lambda id: channel
+    eventbot.bot.get_guild = lambda id: {1: guild, 2: other_guild}[id]
+    eventbot.bot.get_user = lambda id: author
+
+    def ctx(content=''):
+        return Context(guild, author, content)
+
+    for i in range(args.events):
+        eventbot.new_event(ctx(), 'filler{}'.format(i), 'tomorrow {}:15pm'.format(i % 12 + 1))
+    eventbot.get_timezone(guild.id)
+    eventbot.get_timezone(other_guild.id)
+
+    def react(emoji):
+        # Applies the batch on_raw_reaction_add would collect, without waiting for the batch window
+        collection = eventbot.get_collection(guild.id)
+        content = eventbot.pprint_event('scrim', collection=collection)
+        channel.messages[100] = ReactionMessage(100, content + eventbot.pprint_attendance_instructions(), emoji)
+        eventbot.register_event_message(100, guild.id, eventbot.get_event_id('scrim', collection))
+        payloads = [Payload(guild.id, channel.id, 100, author.id, emoji)]
+        return eventbot.apply_reactions(guild.id, channel.id, 100, payloads)
+
+    def join():
+        event = eventbot.get_event('scrim', eventbot.get_collection(guild.id))
+        key = '{} {}'.format(event['_id'], guild.id)
+        return eventbot.join.callback(Context(other_guild, author), key=key)
+
+    commands = [
+        ('schedule', lambda: eventbot.schedule.callback(ctx(), 'scrim', 'tomorrow', '8pm')),
+        ('show', lambda: eventbot.show.callback(ctx(), name='scrim')),
+        ('show_all', lambda: eventbot.show_all.callback(ctx())),
+        ('react_attendance', lambda: react('😃')),
+        ('react_reminder', lambda: react(eventbot.REMINDER_EMOJI)),
+        ('edit', lambda: eventbot.edit.callback(ctx(), 'scrim', 'Description', 'Updated')),
+        ('reschedule', lambda: eventbot.reschedule.callback(ctx(), 'scrim', datetime='tomorrow 9pm')),
+        ('join', join),
+        ('show_linked', lambda: eventbot.show.callback(ctx(), name='scrim')),
+        ('unschedule', lambda: eventbot.unschedule.callback(ctx(), name='scrim')),
+        ('unschedule_past', lambda: eventbot.unschedule_past.callback(ctx())),
+    ]
+
+    for name, command in commands:
+        coroutine = command()
+        probe.reset()
+        loop.run_until_complete(coroutine)
+        dump({'command': name, 'ops': probe.total(), 'by_method': dict(probe.ops)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Replay reactions, commands and reminders into the bot at a given rate.
+
+Feeds a trace of reaction payloads and command messages into the real handlers
+(on_raw_reaction_add and the command callbacks) on one event loop, while the
+send_reminders task sends the reminders that come due. Discord REST calls go
+to stubs which count them and can add latency, and Mongo is mongomock.
+
+Prints one JSON object with the p50/p95/p99 handling latency per input type,
+event loop lag and outbound API calls per input event.
+
+A trace is a JSON lines file, one input per line, sorted by t (seconds from start):
+
+    {"t": 0.10, "type": "reaction", "guild": 1, "event": 3, "user": 17, "emoji": "😃"}
+    {"t": 0.25, "type": "command", "guild": 2, "user": 5, "content": "!show event4"}
+    {"t": 0.40, "type": "reminder", "guild": 1, "event": 0, "user": 9}
+
+event is the index of one of the --events events created in every guild.
+Without --trace a synthetic trace is generated; --record saves it for reuse.
+
+    python bench/replay.py --duration 30 --reaction-rate 200 --command-rate 20 --reminder-rate 5
+    python bench/replay.py --trace tournament.jsonl --api-latency 0.05
+"""
+import argparse, asyncio, collections, datetime, json, random
+
+from common import load_eventbot, DBProbe, Guild, User, Context, heartbeat, percentiles, dump
+
+# Outbound discord API calls made by the stubs below, by kind
+API_CALLS = collections.Counter()
+API_LATENCY = [0.0]
+
+
+async def api_call(kind):
+    API_CALLS[kind] += 1
+    if API_LATENCY[0]:
+        await asyncio.sleep(API_LATENCY[0])
+
+
+class StubUser(User):
+    async def send(self, content=None, **kwargs):
+        await api_call('dm')
+
+
+class StubMessage:
+    def __init__(self, id, content=''):
+        self.id = id
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await api_call('edit')
+        self.content = content
+
+    async def clear_reactions(self):
+        await api_call('clear_reactions')
+
+
+class StubChannel:
+    def __init__(self, id):
+        self.id = id
+        self.messages = {}
+        self.ids = iter(range(10 ** 9, 2 * 10 ** 9))
+
+    async def get_message(self, id):
+        await api_call('get_message')
+        return self.messages[id]
+
+    async def send(self, content=None, **kwargs):
+        await api_call('send')
+        message = StubMessage(next(self.ids), content)
+        self.messages[message.id] = message
+        return message
+
+
+class StubGuild(Guild):
+    def __init__(self, id):
+        super().__init__(id)
+        self.channel = StubChannel(id)
+
+    def get_channel(self, id):
+        return self.channel
+
+
+class StubContext(Context):
+    async def send(self, content=None, **kwargs):
+        return await self.message.guild.channel.send(content, **kwargs)
+
+
+class Payload:
+    def __init__(self, guild_id, channel_id, message_id, user_id, emoji):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.emoji = emoji
+
+
+def synthetic_trace(args, eventbot, rng):
+    """Poisson arrivals; reactions go to a few hot events, like a tournament check-in."""
+    emojis = [emojis[0] for emojis in eventbot.STATUSES.values()] + [eventbot.REMINDER_EMOJI]
+    hot = max(1, int(args.events * args.hot))
+    trace = []
+    for kind, rate in (('reaction', args.reaction_rate), ('command', args.command_rate), ('reminder', args.reminder_rate)):
+        t = 0.0
+        while rate > 0:
+            t += rng.expovariate(rate)
+            if t >= args.duration:
+                break
+            item = {'t': round(t, 4), 'type': kind, 'guild': rng.randrange(args.guilds) + 1, 'user': rng.randrange(args.users)}
+            if kind == 'reaction':
+                item.update(event=rng.randrange(hot), emoji=rng.choice(emojis))
+            elif kind == 'reminder':
+                item.update(event=rng.randrange(args.events))
+            else:
+                item.update(content=rng.choice(['!show event{}'.format(rng.randrange(args.events)), '!show_all']))
+            trace.append(item)
+    trace.sort(key=lambda item: item['t'])
+    return trace
+
+
+def command_runner(eventbot, ctx, content):
+    """Call the command callback for content the way the command parser would."""
+    name, _, rest = content[1:].partition(' ')
+    if name == 'show':
+        return eventbot.show.callback(ctx, name=rest)
+    if name == 'show_all':
+        return eventbot.show_all.callback(ctx, int(rest or 1))
+    if name == 'unschedule':
+        return eventbot.unschedule.callback(ctx, name=rest)
+    raise ValueError('Unsupported command in trace: {}'.format(content))
+
+
+async def replay(eventbot, trace, guilds, users, messages):
+    loop = asyncio.get_event_loop()
+    latencies = collections.defaultdict(list)
+    # message id -> injection times of reactions not yet applied
+    waiting = collections.defaultdict(collections.deque)
+    apply_reactions = eventbot.apply_reactions
+
+    async def timed_apply(guild_id, channel_id, message_id, payloads):
+        await apply_reactions(guild_id, channel_id, message_id, payloads)
+        done = loop.time()
+        for _ in payloads:
+            latencies['reaction'].append(done - waiting[message_id].popleft())
+    eventbot.apply_reactions = timed_apply
+
+    async def run_command(ctx, content, injected):
+        await command_runner(eventbot, ctx, content)
+        latencies['command'].append(loop.time() - injected)
+
+    dm = StubUser.send
+    async def timed_dm(user, content=None, **kwargs):
+        await dm(user, content, **kwargs)
+        if content.startswith('Hey! Your event') and reminder_due[user.id]:
+            latencies['reminder'].append(loop.time() - reminder_due[user.id].popleft())
+    StubUser.send = timed_dm
+    reminder_due = collections.defaultdict(collections.deque)
+
+    lags, stop = [], asyncio.Event()
+    beat = asyncio.ensure_future(heartbeat(lags, stop))
+    sender = asyncio.ensure_future(eventbot.send_reminders())
+    commands = []
+    start = loop.time()
+
+    for item in trace:
+        delay = start + item['t'] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        injected = loop.time()
+        guild = guilds[item['guild']]
+        user = users[item['user']]
+        if item['type'] == 'reaction':
+            message_id = messages[(guild.id, item['event'])]
+            waiting[message_id].append(injected)
+            await eventbot.on_raw_reaction_add(Payload(guild.id, guild.channel.id, message_id, user.id, item['emoji']))
+        elif item['type'] == 'command':
+            ctx = StubContext(guild, user, item['content'])
+            commands.append(asyncio.ensure_future(run_command(ctx, item['content'], injected)))
+        elif item['type'] == 'reminder':
+            # Set now, due straight away, so the lateness is the reminder loop's alone
+            collection = eventbot.get_collection(guild.id)
+            event = await eventbot.run_db(collection.find_one, {'Name': 'event{}'.format(item['event'])}, {'Time': 1})
+            minutes = (event['Time'] - datetime.datetime.now(event['Time'].tzinfo)).total_seconds() / 60
+            reminder_due[user.id].append(injected)
+            await eventbot.run_db(eventbot.set_reminder, 'event{}'.format(item['event']), user, minutes, collection)
+
+    # Drain: commands, reaction batches still waiting for their window, and due reminders
+    await asyncio.gather(*commands)
+    while eventbot.PENDING_REACTIONS or any(reminder_due.values()):
+        await asyncio.sleep(0.05)
+        if loop.time() - start > trace[-1]['t'] + 60:
+            break # give up on anything lost
+
+    elapsed = loop.time() - start
+    stop.set()
+    await beat
+    sender.cancel()
+    eventbot.apply_reactions = apply_reactions
+    StubUser.send = dm
+    return latencies, lags, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trace', help='JSON lines trace to replay instead of a synthetic one')
+    parser.add_argument('--record', help='write the synthetic trace to this file')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of synthetic trace')
+    parser.add_argument('--reaction-rate', type=float, default=100.0, help='reactions per second')
+    parser.add_argument('--command-rate', type=float, default=10.0, help='commands per second')
+    parser.add_argument('--reminder-rate', type=float, default=2.0, help='reminders coming due per second')
+    parser.add_argument('--hot', type=float, default=0.05, help='fraction of events that get reactions')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--events', type=int, default=20, help='events per guild')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every discord API call')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='seconds added to every Mongo call')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    eventbot = load_eventbot()
+    rng = random.Random(args.seed)
+    loop = eventbot.bot.loop
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+        args.guilds = max(item['guild'] for item in trace)
+        args.users = max(item['user'] for item in trace) + 1
+        args.events = max([item.get('event', 0) for item in trace] + [args.events - 1]) + 1
+    else:
+        trace = synthetic_trace(args, eventbot, rng)
+        if args.record:
+            with open(args.record, 'w') as f:
+                for item in trace:
+                    f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    if not trace:
+        parser.error('the trace is empty')
+
+    guilds = {i: StubGuild(i) for i in range(1, args.guilds + 1)}
+    users = {i: StubUser(i) for i in range(args.users)}
+    eventbot.bot.get_guild = guilds.get
+    eventbot.bot.get_user = users.get
+    eventbot.bot._connection.user = StubUser(-1, 'eventbot')
+    async def ready():
+        pass
+    eventbot.bot.wait_until_ready = ready
+
+    # Every guild gets the same events, each shown once so reactions can be matched to it
+    messages = {}
+    base = datetime.datetime.now(eventbot.DEFAULT_TZ) + datetime.timedelta(days=2)
+    for guild in guilds.values():
+        for i in range(args.events):
+            when = (base + datetime.timedelta(hours=i)).strftime('%m/%d/%Y %H:%M')
+            msg, event = eventbot.new_event(Context(guild, users[0]), 'event{}'.format(i), when)
+            message = StubMessage(guild.id * 10 ** 6 + i, msg)
+            guild.channel.messages[message.id] = message
+            eventbot.register_event_message(message.id, guild.id, event['_id'])
+            messages[(guild.id, i)] = message.id
+
+    probe = DBProbe().install()
+    probe.latency = args.db_latency
+    API_LATENCY[0] = args.api_latency
+    API_CALLS.clear()
+
+    latencies, lags, elapsed = loop.run_until_complete(replay(eventbot, trace, guilds, users, messages))
+
+    inputs = collections.Counter(item['type'] for item in trace)
+    result = {'inputs': dict(inputs), 'elapsed': round(elapsed, 2), 'trace_seconds': trace[-1]['t'],
+              'api_calls': dict(API_CALLS), 'api_calls_per_input': round(sum(API_CALLS.values()) / len(trace), 3),
+              'db_ops_per_input': round(probe.total() / len(trace), 3),
+              'api_latency': args.api_latency, 'db_latency': args.db_latency}
+    for kind in inputs:
+        result['handled_' + kind] = len(latencies[kind])
+        result.update({'{}_ms_{}'.format(kind, k): v and round(v * 1000, 2) for k, v in percentiles(latencies[kind]).items()})
+    result.update({'loop_lag_ms_' + k: v and round(v * 1000, 2) for k, v in percentiles(lags).items()})
+    result['loop_lag_ms_max'] = round(max(lags) * 1000, 2) if lags else None
+    dump(result)
+
+
+if __name__ == '__main__':
+    main()
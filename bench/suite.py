@@ -0,0 +1,137 @@
+"""Throughput, latency and Mongo operations of the main helpers.
+
+Fills an in-memory mongomock database with guilds x events x attendees, then
+times new_event, set_attendance, pprint_all_events, delete_past_events and one
+reminder dispatch cycle (what send_reminders does each time reminders are due).
+Prints one JSON object for the dataset and one per helper.
+
+    python bench/suite.py --guilds 1000 --events 100 --attendees 20
+    python bench/suite.py --storage single
+"""
+import argparse, datetime, os, random, time
+
+from common import load_eventbot, DBProbe, Guild, User, Context, percentiles, dump
+
+
+def populate(eventbot, guilds, args, rng):
+    """Insert the dataset directly, in the same shape new_event creates."""
+    now = datetime.datetime.now(eventbot.DEFAULT_TZ)
+    statuses = list(eventbot.STATUSES)
+    events = {}
+    for guild in guilds:
+        docs = []
+        for i in range(args.events):
+            past = i < args.events * args.past
+            offset = datetime.timedelta(hours=i + 1)
+            event = {'Name': 'event{}'.format(i),
+                     'Author': 'user0#0001',
+                     'Time': now - offset if past else now + offset,
+                     'Description': 'No description.',
+                     'Metadata': {'Reminders': {}, 'GuildID': guild.id}}
+            for status in statuses:
+                event[status] = []
+            for user_id in rng.sample(range(args.users), args.attendees):
+                event[rng.choice(statuses)].append({'ID': user_id, 'Name': 'user{}#0001'.format(user_id)})
+            docs.append(event)
+        eventbot.get_collection(guild.id).insert_many(docs)
+        events[guild.id] = [event['Name'] for event in docs if event['Time'] > now]
+    return events
+
+
+def measure(name, probe, calls, run):
+    """Time run(i) for each call, counting Mongo operations across all of them."""
+    samples = []
+    probe.reset()
+    for i in range(calls):
+        start = time.perf_counter()
+        run(i)
+        samples.append(time.perf_counter() - start)
+    result = {'helper': name, 'calls': calls,
+              'calls_per_sec': round(calls / sum(samples), 1) if samples else None,
+              'db_ops_per_call': round(probe.total() / calls, 2) if calls else None,
+              'db_ops_by_method': dict(probe.ops)}
+    result.update({'latency_ms_' + k: v and round(v * 1000, 3) for k, v in percentiles(samples).items()})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--events', type=int, default=100, help='events per guild')
+    parser.add_argument('--attendees', type=int, default=10, help='attendees per event')
+    parser.add_argument('--users', type=int, default=1000, help='distinct users attendees are drawn from')
+    parser.add_argument('--past', type=float, default=0.1, help='fraction of events already over')
+    parser.add_argument('--calls', type=int, default=500, help='calls per helper')
+    parser.add_argument('--reminders', type=int, default=50, help='reminders due per dispatch cycle')
+    parser.add_argument('--cycles', type=int, default=20, help='reminder dispatch cycles')
+    parser.add_argument('--storage', choices=['guild', 'single'], default='guild')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.attendees = min(args.attendees, args.users)
+
+    os.environ['STORAGE_MODE'] = args.storage
+    eventbot = load_eventbot()
+    rng = random.Random(args.seed)
+    guilds = [Guild(i + 1) for i in range(args.guilds)]
+    users = {i: User(i) for i in range(args.users)}
+    eventbot.bot.get_user = users.get
+
+    start = time.perf_counter()
+    events = populate(eventbot, guilds, args, rng)
+    dump({'dataset': True, 'guilds': args.guilds, 'events_per_guild': args.events,
+          'attendees_per_event': args.attendees, 'storage': args.storage,
+          'setup_seconds': round(time.perf_counter() - start, 2)})
+
+    probe = DBProbe().install()
+    loop = eventbot.bot.loop
+    base = datetime.datetime.now(eventbot.DEFAULT_TZ) + datetime.timedelta(days=400)
+
+    def new_event(i):
+        guild = rng.choice(guilds)
+        when = (base + datetime.timedelta(minutes=i)).strftime('%m/%d/%Y %H:%M')
+        msg, event = eventbot.new_event(Context(guild, users[0]), 'new{}'.format(i), when)
+        assert event is not None, msg
+
+    def set_attendance(i):
+        guild = rng.choice(guilds)
+        name = rng.choice(events[guild.id])
+        user = users[rng.randrange(args.users)]
+        eventbot.set_attendance(name, user, rng.choice(list(eventbot.STATUSES)), eventbot.get_collection(guild.id))
+
+    def pprint_all_events(i):
+        eventbot.pprint_all_events(rng.choice(guilds).id)
+
+    def delete_past_events(i):
+        eventbot.delete_past_events(guilds[i].id)
+
+    def reminder_cycle(i):
+        # Set reminders far enough ahead that they are all due now, then send them in one cycle
+        for _ in range(args.reminders):
+            guild = rng.choice(guilds)
+            user = users[rng.randrange(args.users)]
+            eventbot.set_reminder(rng.choice(events[guild.id]), user, 60 * 24 * 365, eventbot.get_collection(guild.id))
+        due = eventbot.pop_due_reminders()
+        probe.reset()
+        start = time.perf_counter()
+        loop.run_until_complete(eventbot.dispatch_reminders(due))
+        cycle_samples.append(time.perf_counter() - start)
+        cycle_ops.append(probe.total())
+
+    dump(measure('new_event', probe, args.calls, new_event))
+    dump(measure('set_attendance', probe, args.calls, set_attendance))
+    dump(measure('pprint_all_events', probe, args.calls, pprint_all_events))
+    dump(measure('delete_past_events', probe, min(args.calls, len(guilds)), delete_past_events))
+
+    # Only the dispatch itself is timed, not setting the reminders up
+    cycle_samples, cycle_ops = [], []
+    for i in range(args.cycles):
+        reminder_cycle(i)
+    result = {'helper': 'reminder_cycle', 'calls': args.cycles, 'reminders_per_cycle': args.reminders,
+              'reminders_per_sec': round(args.cycles * args.reminders / sum(cycle_samples), 1),
+              'db_ops_per_call': round(sum(cycle_ops) / len(cycle_ops), 2)}
+    result.update({'latency_ms_' + k: round(v * 1000, 3) for k, v in percentiles(cycle_samples).items()})
+    dump(result)
+
+
+if __name__ == '__main__':
+    main()
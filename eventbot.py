@@ -1,22 +1,30 @@
-import discord, datetime, asyncio, pytz, logging
+from time import monotonic, sleep
+STARTUP_START = monotonic() # before the other imports, so the startup report can time them
+
+import discord, datetime, asyncio, pytz, logging, heapq, itertools, functools, threading, collections, re, bisect
+import sys, io, traceback, csv, json, tempfile, copy, os
 from logging import info, warning, debug, error, critical
 from discord.ext import commands
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, ReplaceOne, UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure, BulkWriteError
+from pymongo import monitoring
 from bson.codec_options import CodecOptions
 from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from os import environ
 from pytz import timezone
-from dateparser import parse
 
 __python__ = 3.6
 __author__ = "github.com/meeow/eventbot" 
-__version__ = '2.2.1'
+__version__ = '2.3'
 
 # Files in this repo:
 # - eventbot.py (this file!)
 # - Procfile 
 # - requirements.txt
 # - README.md
+# - bench/ (offline benchmarks, see bench/common.py)
 
 # TODO:
 # - Add command to set custom time in advance to send reminder
@@ -27,13 +35,10 @@ __version__ = '2.2.1'
 # - Refactor link (find event by key)
 
 # Nice to have:
-# - Chronological order !show_all 
 # - Destroy background tasks more cleanly
-# - Auto-prune stale events
 # - Cleaner param input
 
 # Bugs:
-# - May have unexpected behavior if another user reacts before the bot clears the previous user's reaction
 # - Cannot make 2 events of the same name even if it is owned by a different guild
 # - It is possible to set a reminder for an event which has been deleted
 
@@ -67,6 +72,30 @@ __version__ = '2.2.1'
 #   - Add help docs for !join 
 # v2.2.2
 #   - Add more emoji options for yes and no reactions
+# v2.3
+#   - Send reminders from an in-memory schedule instead of polling every event
+#   - Run database calls on a worker pool so they never block the event loop
+#   - Cache server config in memory
+#   - Look each event up once per command instead of up to five times
+#   - Fix simultaneous reactions overwriting each other's attendance
+#   - Create database indexes automatically
+#   - Optionally store every server's events in one collection (!migrate_storage)
+#   - !show_all lists events in chronological order, split into pages
+#   - Cache rendered events
+#   - Apply reactions arriving close together on one message as a batch
+#   - Remember which messages show which event, ignore reactions to other messages
+#   - Store user ids with attendance and reminders, !migrate_user_ids converts old events
+#   - Send due reminders concurrently, retry rate limited and failed DMs
+#   - Parse common date/time formats without dateparser, remember parsed inputs
+#   - Connect to the database and load timezones on first use, log startup times
+#   - Metrics for commands, handlers, database calls, reminders and loop lag: !stats and METRICS_PORT
+#   - Log the stack of anything blocking the event loop, !profile samples stacks for flame graphs
+#   - Delete events automatically a while after they start, optionally keeping a copy in event_history
+#   - !schedule_bulk creates events from an attached CSV or ICS file
+#   - Weekly recurring events, created a week ahead or when shown: !schedule_weekly
+#   - !export sends the guild's events as an ICS or JSON lines file
+#   - Linked events keep a summary of the other team's attendance, so showing them reads one event
+#   - Optional write-behind buffer for attendance and reminders: WRITE_BEHIND=1
 
 # Todo: configurable admin level
 
@@ -76,31 +105,323 @@ logging.basicConfig(level=logging.INFO)
 def log_command(ctx):
     info("{} ({}): {}".format(ctx.message.author.name, ctx.message.guild.name, ctx.message.content))
 
+
+# ==== Metrics ====
+# Counters and latency histograms, kept in memory. Served in Prometheus text format on
+# METRICS_PORT (localhost only) if it is set, and summarized by !stats.
+
+# Port to serve metrics on, or 0 to not serve them
+METRICS_PORT = int(environ.get('METRICS_PORT', 0))
+# Upper bounds of histogram buckets, in seconds
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds between event loop lag measurements
+LOOP_LAG_INTERVAL = 1.0
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1) # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # float q: quantile between 0 and 1
+    # Returns upper bound of the bucket the quantile falls in, or None if nothing was observed
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+# metric name -> {tuple of (label, value) pairs: Histogram or counter value}
+HISTOGRAMS = collections.defaultdict(dict)
+COUNTERS = collections.defaultdict(dict)
+# metric name -> function returning the current value, read when metrics are collected
+GAUGES = {}
+METRICS_HELP = {
+    'eventbot_command_seconds': 'Time to run each command',
+    'eventbot_command_errors_total': 'Commands which raised an error',
+    'eventbot_handler_seconds': 'Time to run each event handler and background step',
+    'eventbot_db_seconds': 'Time of each Mongo command, by the helper which made it',
+    'eventbot_db_errors_total': 'Mongo commands which failed, by the helper which made them',
+    'eventbot_reminders_total': 'Reminders handled, by result',
+    'eventbot_reminder_lateness_seconds': 'Time between a reminder being due and it being picked up',
+    'eventbot_reminder_backlog': 'Reminders scheduled but not sent yet',
+    'eventbot_loop_lag_seconds': 'How late the event loop wakes up a sleeping task',
+    'eventbot_loop_stalls_total': 'Times the event loop was blocked for over STALL_THRESHOLD, by handler',
+    'eventbot_write_buffer_pending': 'Buffered writes not flushed to the database yet',
+    'eventbot_config_cache_hits': 'Server config reads served from the config cache',
+    'eventbot_config_cache_misses': 'Server config reads which went to the database',
+    'eventbot_render_cache_hits': 'Event renders served from the render cache',
+    'eventbot_render_cache_misses': 'Event renders not found in the render cache',
+    'eventbot_render_cache_evictions': 'Event renders dropped to keep the render cache under RENDER_CACHE_SIZE',
+}
+METRICS_LOCK = threading.Lock()
+
+# string name: name of histogram
+# dict labels: label -> value
+# float value: observed value, in seconds
+def observe(name, labels, value):
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        histogram = HISTOGRAMS[name].get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[name][key] = Histogram()
+        histogram.observe(value)
+
+# string name: name of counter
+# dict labels: label -> value
+def increment(name, labels, amount=1):
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        COUNTERS[name][key] = COUNTERS[name].get(key, 0) + amount
+
+# string name: name of histogram the time spent is observed in
+# dict labels: labels of the observation
+# Decorator for coroutines, times every call
+def timed(name, **labels):
+    def decorator(coroutine):
+        @functools.wraps(coroutine)
+        async def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return await coroutine(*args, **kwargs)
+            finally:
+                observe(name, labels, monotonic() - start)
+        return wrapper
+    return decorator
+
+def pprint_labels(key, extra=()):
+    pairs = key + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('"', '\\"')) for label, value in pairs) + '}'
+
+# Returns every metric in Prometheus text format
+def pprint_metrics():
+    lines = []
+    with METRICS_LOCK:
+        for name, series in sorted(HISTOGRAMS.items()):
+            lines.append('# HELP {} {}'.format(name, METRICS_HELP.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, pprint_labels(key, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, pprint_labels(key), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, pprint_labels(key), histogram.count))
+        for name, series in sorted(COUNTERS.items()):
+            lines.append('# HELP {} {}'.format(name, METRICS_HELP.get(name, name)))
+            lines.append('# TYPE {} counter'.format(name))
+            for key, value in sorted(series.items()):
+                lines.append('{}{} {}'.format(name, pprint_labels(key), value))
+    for name, read in sorted(GAUGES.items()):
+        lines.append('# HELP {} {}'.format(name, METRICS_HELP.get(name, name)))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, read()))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = pprint_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes would flood the log
+
+# int port: port to serve /metrics on, on localhost
+def start_metrics_server(port):
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    info("Serving metrics on port {}".format(port))
+    return server
+
+# Name of the helper each thread is running for run_db, so database calls can be attributed to it
+DB_HELPER = threading.local()
+
+# Times every Mongo command. pymongo calls it on the thread which made the command.
+class DBMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        labels = {'helper': getattr(DB_HELPER, 'name', 'other'), 'command': event.command_name}
+        observe('eventbot_db_seconds', labels, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = {'helper': getattr(DB_HELPER, 'name', 'other'), 'command': event.command_name}
+        observe('eventbot_db_seconds', labels, event.duration_micros / 1e6)
+        increment('eventbot_db_errors_total', labels)
+
+# ==== Watchdog and profiler ====
+# A task on the event loop updates LOOP_HEARTBEAT several times a second. The watchdog
+# thread logs the loop thread's stack whenever the heartbeat is older than STALL_THRESHOLD,
+# which means a callback has been running that long without giving the loop back.
+
+# Seconds the event loop may be blocked before its stack is logged
+STALL_THRESHOLD = float(environ.get('STALL_THRESHOLD', 1.0))
+# Seconds between heartbeats, and between watchdog checks
+WATCHDOG_INTERVAL = 0.1
+# Seconds between stack samples taken by !profile
+PROFILE_INTERVAL = 0.005
+# Longest !profile run, in seconds
+PROFILE_MAX_SECONDS = 60
+
+LOOP_HEARTBEAT = {'time': None, 'thread': None}
+
+async def loop_heartbeat():
+    LOOP_HEARTBEAT['thread'] = threading.get_ident()
+    while 1:
+        LOOP_HEARTBEAT['time'] = monotonic()
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+
+def watchdog():
+    reported = None # heartbeat of the stall already logged, so each stall is logged once
+    while 1:
+        beat = LOOP_HEARTBEAT['time']
+        if beat is not None and beat != reported and monotonic() - beat > STALL_THRESHOLD:
+            frame = sys._current_frames().get(LOOP_HEARTBEAT['thread'])
+            if frame is not None:
+                handler = frame_handler(frame)
+                warning("Event loop blocked for over {:.1f}s in {}:\n{}".format(
+                    monotonic() - beat, handler, ''.join(traceback.format_stack(frame))))
+                increment('eventbot_loop_stalls_total', {'handler': handler})
+            reported = beat
+        sleep(WATCHDOG_INTERVAL)
+
+# Start the heartbeat task and the watchdog thread, once the event loop exists
+def start_watchdog():
+    bot.loop.create_task(loop_heartbeat())
+    threading.Thread(target=watchdog, name='watchdog', daemon=True).start()
+
+# frame frame: innermost frame of a stack
+# Returns name of the innermost command or event handler on the stack, or 'unknown'
+def frame_handler(frame):
+    handlers = {command.callback.__code__ for command in bot.commands}
+    handlers.update(getattr(func, '__wrapped__', func).__code__ for func in (on_ready, warm_up,
+        on_raw_reaction_add, process_reactions, apply_reactions, send_reminders, dispatch_reminders, send_reminder))
+    while frame is not None:
+        if frame.f_code in handlers:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+# frame frame: innermost frame of a stack
+# Returns stack as outermost;...;innermost, each frame as function (file:line)
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, code.co_filename.rsplit('/', 1)[-1], code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# float seconds: how long to sample for
+# Returns stacks of every thread sampled every PROFILE_INTERVAL seconds, in the collapsed
+# format read by flamegraph.pl and speedscope: "thread;outermost;...;innermost count" per line
+def profile(seconds):
+    samples = collections.Counter()
+    me = threading.get_ident()
+    names = {}
+    end = monotonic() + seconds
+    while monotonic() < end:
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            thread = 'event loop' if ident == LOOP_HEARTBEAT['thread'] else names.get(ident, ident)
+            samples['{};{}'.format(thread, collapse_stack(frame))] += 1
+        sleep(PROFILE_INTERVAL)
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in samples.most_common())
+
+
 # ==== Database and Context Setup ====
 
 HEROKU = 1
 
+# If set to 1, the database connection and other setup not needed to log in to discord
+# happen on first use or in the background after on_ready, instead of at import
+LAZY_STARTUP = environ.get('LAZY_STARTUP', '0') == '1'
+
 # Heroku environment variables 
 if HEROKU:
-    client = MongoClient("ds018498.mlab.com", 18498)
-    db = client.eventbot
     BOT_TOKEN = environ['BOT_TOKEN'] 
     MLAB_USER = environ['MONGOUSER']
     MLAB_PASS = environ['MONGOPASS']
-    db.authenticate(MLAB_USER, MLAB_PASS)
+    # Credentials are passed to the client so it authenticates when it connects,
+    # which with connect=False is on the first database call
+    client = MongoClient("ds018498.mlab.com", 18498, username=MLAB_USER, password=MLAB_PASS,
+                         authSource='eventbot', connect=not LAZY_STARTUP, event_listeners=[DBMetricsListener()])
+    db = client.eventbot
 else:
-    client = MongoClient()
+    client = MongoClient(connect=not LAZY_STARTUP, event_listeners=[DBMetricsListener()])
     db = client.eventbot
     BOT_TOKEN = open('../bot_token.txt', 'r').read().strip('\n')
 
 EVENTS = db.events.with_options(codec_options=CodecOptions(tz_aware=True))
 CONFIG = db.config.with_options(codec_options=CodecOptions(tz_aware=True))
+MIGRATIONS = db.migrations
+MESSAGES = db.messages
+FAILED_REMINDERS = db.failed_reminders.with_options(codec_options=CodecOptions(tz_aware=True))
+HISTORY = db.event_history.with_options(codec_options=CodecOptions(tz_aware=True))
+RULES = db.recurring.with_options(codec_options=CodecOptions(tz_aware=True))
+
+# How events are laid out in the database:
+# - 'guild': one collection per guild, named by the guild's id
+# - 'single': the events collection holds every guild's events, keyed by Metadata.GuildID.
+#   Copy existing guild collections into it with !migrate_storage before switching.
+STORAGE_MODE = environ.get('STORAGE_MODE', 'guild')
+# Number of events copied per round trip by !migrate_storage
+MIGRATION_BATCH_SIZE = 500
+
+# Maximum number of database calls allowed to run at the same time
+DB_CONCURRENCY = int(environ.get('DB_CONCURRENCY', 8))
+# Seconds before a cached server config is re-read from the database. Only needed
+# if several bot processes share the database; 0 keeps it until changed here.
+CONFIG_CACHE_TTL = float(environ.get('CONFIG_CACHE_TTL', 0))
 
 # ==== Bot default options ====
 bot = commands.Bot(command_prefix='!')
 
 # Change seconds before deleting error messages 
 TEMP_MESSAGE_DURATION = 5.0 
+# Discord rejects messages longer than this many characters
+MESSAGE_LIMIT = 2000
+# Number of events listed per page of !show_all
+EVENTS_PER_PAGE = 20
+# Largest file and number of events accepted by !schedule_bulk
+BULK_IMPORT_MAX_BYTES = 1024 * 1024
+BULK_IMPORT_MAX_EVENTS = 1000
+# Events checked for conflicts and inserted per round trip by !schedule_bulk
+BULK_IMPORT_BATCH_SIZE = 250
+# Events read per round trip by !export
+EXPORT_BATCH_SIZE = 200
+# Exports larger than this many bytes are buffered on disk instead of in memory
+EXPORT_SPOOL_BYTES = 1024 * 1024
+# Occurrences of recurring events are created this many days before they start
+RECURRING_LOOKAHEAD_DAYS = 7
+# Interval to create upcoming occurrences of recurring events, in seconds
+RECURRING_CHECK_CYCLE = 3600
+# Number of rendered events kept in memory
+RENDER_CACHE_SIZE = int(environ.get('RENDER_CACHE_SIZE', 512))
+# Number of parsed date/time inputs to remember
+PARSE_CACHE_SIZE = 256
 
 # Add more statuses to future events simply by changing this
 STATUSES = {"Yes":['😃', '😀', '☺️', '😄', '😁', '🙂', '😺', '😸'], 
@@ -112,16 +433,51 @@ STATUSES = {"Yes":['😃', '😀', '☺️', '😄', '😁', '🙂', '😺', '
 REMINDER_TIME = 20
 # Emoji used to issue a shortcut reminder request
 REMINDER_EMOJI = '⏰'
-# Interval to check for reminders which need sending, in seconds
-REMINDER_CYCLE = 10
+# Seconds to collect reactions to a message before applying them together
+REACTION_BATCH_WINDOW = 1.0
+# Messages remembered as not showing an event, so reactions to them are dropped without fetching them again
+NON_EVENT_MESSAGES_SIZE = 4096
+# Longest time the reminder scheduler sleeps before re-checking its schedule, in seconds
+REMINDER_CYCLE = 60
+# Reminder DMs sent at the same time
+REMINDER_CONCURRENCY = 10
+# Attempts to send a reminder DM which is rate limited or fails on discord's side
+REMINDER_ATTEMPTS = 4
+# Seconds to wait before retrying a reminder DM, doubled after every attempt
+REMINDER_RETRY_DELAY = 1.0
+# Seconds before reminders whose dispatch failed on the database are tried again
+REMINDER_REQUEUE_DELAY = 10
 
 # Interval to check for stale events, in seconds
-STALE_CHECK_CYCLE = REMINDER_CYCLE
+STALE_CHECK_CYCLE = 3600
+# Hours after an event starts before it is deleted automatically, e.g. 168 for a week.
+# 0 (the default) keeps events until !unschedule_past
+EVENT_EXPIRY_HOURS = float(environ.get('EVENT_EXPIRY_HOURS', 0))
+# If set, events deleted because they are over are copied to the event_history collection first
+ARCHIVE_EVENTS = environ.get('ARCHIVE_EVENTS', '0') == '1'
+
+# If set, attendance and reminder changes are buffered and written in bulk, see write-behind buffer
+WRITE_BEHIND = environ.get('WRITE_BEHIND', '0') == '1'
+# Seconds between flushes of the write-behind buffer
+WRITE_FLUSH_INTERVAL = float(environ.get('WRITE_FLUSH_INTERVAL', 0.5))
+# Buffered writes which trigger a flush without waiting for the interval
+WRITE_FLUSH_OPS = int(environ.get('WRITE_FLUSH_OPS', 500))
+# Buffered writes not flushed yet are appended to this file and written again at startup.
+# Must be on storage which survives a restart: a Heroku dyno's filesystem does not.
+WRITE_JOURNAL = environ.get('WRITE_JOURNAL', 'write_journal.jsonl')
 
 # Timezone
 DEFAULT_TZ = timezone('US/Eastern')
-VALID_TZ = set(pytz.all_timezones)
-US_TZ = set([tz for tz in pytz.all_timezones if tz.startswith('US')])
+
+# Returns set of names of every timezone. Checks a file per timezone, so only built when needed.
+@functools.lru_cache(maxsize=1)
+def valid_timezones():
+    return set(pytz.all_timezones)
+
+# Returns set of names of US timezones, listed by !timezone
+@functools.lru_cache(maxsize=1)
+def us_timezones():
+    return set([tz for tz in valid_timezones() if tz.startswith('US')])
 
 # Top 'x' number of roles in the server's role hierarchy allowed to perform admin commands
 DEFAULT_ADMIN_LEVEL = 1 
@@ -131,9 +487,106 @@ RESTRICTED = {"Author", "Metadata", "Time", "Date"}
 
 # ==== Helper Functions: MongoDB interface ====
 
+# Returns the events of guild_id as a collection, whichever storage mode is used
 def get_collection(guild_id):
     guild_id = str(guild_id)
-    return db[guild_id].with_options(codec_options=CodecOptions(tz_aware=True))
+    if STORAGE_MODE == 'single':
+        collection = GuildEvents(EVENTS, guild_id)
+        index_key = EVENTS.name
+    else:
+        collection = get_guild_collection(guild_id)
+        index_key = guild_id
+
+    if index_key not in INDEXED_COLLECTIONS:
+        # First use by this process, make sure the indexes exist without waiting for them
+        INDEXED_COLLECTIONS.add(index_key)
+        DB_EXECUTOR.submit(ensure_event_indexes, collection)
+    return collection
+
+# Returns the per guild collection of guild_id, regardless of storage mode
+def get_guild_collection(guild_id):
+    return db[str(guild_id)].with_options(codec_options=CodecOptions(tz_aware=True))
+
+# Returns ids (as strings) of every guild with events stored
+def guild_ids():
+    if STORAGE_MODE == 'single':
+        return [str(guild_id) for guild_id in EVENTS.distinct('Metadata.GuildID') if guild_id is not None]
+    return [name for name in db.collection_names() if name.isdigit()]
+
+# dict filter: query to run against every guild
+# dict projection: fields to return, or None for whole events
+# Yields (guild_id, event) for matching events of every guild
+def find_all_guild_events(filter, projection=None):
+    if STORAGE_MODE == 'single':
+        filter = dict(filter, **{'Metadata.GuildID': {'$ne': None}})
+        if projection is not None:
+            projection = dict(projection, **{'Metadata.GuildID': 1})
+        for event in EVENTS.find(filter, projection):
+            yield str(event['Metadata']['GuildID']), event
+    else:
+        for guild_id in guild_ids():
+            for event in get_guild_collection(guild_id).find(filter, projection):
+                yield guild_id, event
+
+class GuildEvents:
+    '''One guild's events inside the shared events collection.
+
+    Provides the parts of the pymongo Collection interface the helpers use and
+    scopes every call to the guild, so helpers work the same in either storage mode.
+    '''
+    def __init__(self, collection, guild_id):
+        self.collection = collection
+        self.name = str(guild_id)
+        self.guild_id = int(guild_id)
+
+    def scope(self, filter=None):
+        scoped = {'Metadata.GuildID': self.guild_id}
+        scoped.update(filter or {})
+        return scoped
+
+    def find(self, filter=None, *args, **kwargs):
+        return self.collection.find(self.scope(filter), *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self.collection.find_one(self.scope(filter), *args, **kwargs)
+
+    def count_documents(self, filter, **kwargs):
+        return self.collection.count_documents(self.scope(filter), **kwargs)
+
+    def insert_one(self, document, **kwargs):
+        document.setdefault('Metadata', {})['GuildID'] = self.guild_id
+        return self.collection.insert_one(document, **kwargs)
+
+    def insert_many(self, documents, **kwargs):
+        for document in documents:
+            document.setdefault('Metadata', {})['GuildID'] = self.guild_id
+        return self.collection.insert_many(documents, **kwargs)
+
+    def update_one(self, filter, update, **kwargs):
+        return self.collection.update_one(self.scope(filter), update, **kwargs)
+
+    def update_many(self, filter, update, **kwargs):
+        return self.collection.update_many(self.scope(filter), update, **kwargs)
+
+    def find_one_and_update(self, filter, update, **kwargs):
+        return self.collection.find_one_and_update(self.scope(filter), update, **kwargs)
+
+    def find_one_and_delete(self, filter, **kwargs):
+        return self.collection.find_one_and_delete(self.scope(filter), **kwargs)
+
+    def delete_one(self, filter, **kwargs):
+        return self.collection.delete_one(self.scope(filter), **kwargs)
+
+    def delete_many(self, filter, **kwargs):
+        return self.collection.delete_many(self.scope(filter), **kwargs)
+
+    def bulk_write(self, requests, **kwargs):
+        # Not scoped: callers must select events by _id, which is unique across guilds
+        return self.collection.bulk_write(requests, **kwargs)
+
+    def create_index(self, keys, **kwargs):
+        # Indexes of the shared collection are prefixed by guild
+        return self.collection.create_index([('Metadata.GuildID', ASCENDING)] + list(keys), **kwargs)
 
 # int id: value of _id field of target mongodb document 
 # * key: name of field to update
@@ -153,11 +606,115 @@ def update_field(id, key, value, collection=EVENTS):
             key: value
         }
     }, upsert=False)
+    bump_event_version(id)
     return result
 
 
+# ==== Helper Functions: Async database access ====
+# pymongo is blocking, so every helper which touches the database is run on this
+# pool instead of directly inside a coroutine. A slow round trip then only holds
+# up the command which made it, not heartbeats and every other guild.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix='db')
+
+# function func: blocking helper to call off the event loop
+# args, kwargs: arguments to call func with
+async def run_db(func, *args, **kwargs):
+    return await bot.loop.run_in_executor(DB_EXECUTOR, functools.partial(call_helper, func, args, kwargs))
+
+# Runs on a DB_EXECUTOR thread, recording which helper the database calls are made for
+def call_helper(func, args, kwargs):
+    DB_HELPER.name = getattr(func, '__name__', 'other')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        DB_HELPER.name = 'other'
+
+
+# ==== Helper Functions: Indexes ====
+
+# Names of guild collections whose indexes have been ensured by this process
+INDEXED_COLLECTIONS = set()
+
+# collection collection: collection to create index in
+# list keys: index specification as passed to create_index
+# string name: name of index
+# bool unique: enforce uniqueness, falling back to a plain index if existing documents have duplicates
+def ensure_index(collection, keys, name, unique=False):
+    try:
+        collection.create_index(keys, name=name, unique=unique)
+    except OperationFailure as e:
+        if not unique:
+            raise
+        warning("Cannot create unique index {} on {}, creating non-unique index instead: {}".format(name, collection.name, e))
+        collection.create_index(keys, name=name)
+
+# collection collection: guild collection to create event indexes for
+def ensure_event_indexes(collection):
+    ensure_index(collection, [('Name', ASCENDING)], 'name', unique=True)
+    ensure_index(collection, [('Time', ASCENDING)], 'time')
+
+def ensure_config_indexes():
+    ensure_index(CONFIG, [('ID', ASCENDING)], 'id', unique=True)
+    ensure_index(MESSAGES, [('Event', ASCENDING)], 'event')
+    ensure_index(RULES, [('GuildID', ASCENDING), ('Name', ASCENDING)], 'guild_name', unique=True)
+
+# Create missing indexes for the config and every existing guild collection
+def ensure_all_indexes():
+    ensure_config_indexes()
+    if STORAGE_MODE == 'single':
+        INDEXED_COLLECTIONS.add(EVENTS.name)
+        ensure_event_indexes(GuildEvents(EVENTS, 0))
+        info("Ensured indexes for shared events collection.")
+        return
+
+    for name in guild_ids():
+        if name not in INDEXED_COLLECTIONS:
+            INDEXED_COLLECTIONS.add(name)
+            ensure_event_indexes(get_guild_collection(name))
+    info("Ensured indexes for {} guild collections.".format(len(INDEXED_COLLECTIONS)))
+
+# dict plan: winningPlan from the output of explain
+# Returns the stages of plan as a string, e.g. FETCH > IXSCAN (name)
+def pprint_plan(plan):
+    stages = []
+    plan = plan.get('queryPlan', plan) # slot based execution engine wraps the classic plan
+    while plan:
+        stage = plan['stage']
+        if 'indexName' in plan:
+            stage += ' ({})'.format(plan['indexName'])
+        stages.append(stage)
+        plan = plan.get('inputStage')
+    return ' > '.join(stages)
+
+# int guild_id: guild whose collection to explain the helper queries against
+def pprint_index_report(guild_id):
+    collection = get_collection(guild_id)
+    present = datetime.datetime.now(DEFAULT_TZ)
+    queries = [
+        ('find_event', collection, {'Name': ''}),
+        ('time_exists', collection, {'Time': present}),
+        ('get_config', CONFIG, {'ID': int(guild_id)}),
+        ('load_reminders', collection, {'Metadata.Reminders': {'$ne': {}}}),
+    ]
+
+    msg = ''
+    for helper, target, query in queries:
+        plan = target.find(query).explain()['queryPlanner']['winningPlan']
+        msg += "{}: {}\n".format(helper, pprint_plan(plan))
+    return msg
+
+
 # ==== Helper Functions: Server config ====
 
+# int guild_id -> (config document or None, monotonic time it was read)
+CONFIG_CACHE = {}
+CONFIG_CACHE_STATS = {'hits': 0, 'misses': 0}
+# int guild_id -> number of times its config was invalidated. A read only stores its
+# result if no invalidation happened since it started, so a config read on one thread
+# just before another changes it is never cached.
+CONFIG_GENERATIONS = collections.defaultdict(int)
+CONFIG_LOCK = threading.Lock()
+
 # int guild_id: id of guild to find mongodb _id of
 def config_to_id(guild_id):
     guild = CONFIG.find_one({'ID': guild_id})
@@ -171,9 +728,39 @@ def id_to_name(guild_id):
 
 # int guild_id: guild_id of guild whose config to return
 def get_config(guild_id):
+    guild_id = int(guild_id)
+    cached = CONFIG_CACHE.get(guild_id)
+    if cached and not (CONFIG_CACHE_TTL and monotonic() - cached[1] > CONFIG_CACHE_TTL):
+        with CONFIG_LOCK:
+            CONFIG_CACHE_STATS['hits'] += 1
+        return cached[0]
+
+    with CONFIG_LOCK:
+        CONFIG_CACHE_STATS['misses'] += 1
+        generation = CONFIG_GENERATIONS[guild_id]
     config = CONFIG.find_one({'ID': guild_id})
+    with CONFIG_LOCK:
+        if CONFIG_GENERATIONS[guild_id] == generation:
+            CONFIG_CACHE[guild_id] = (config, monotonic())
     return config
 
+# int guild_id: guild_id of guild whose config was changed
+def invalidate_config(guild_id):
+    with CONFIG_LOCK:
+        CONFIG_GENERATIONS[int(guild_id)] += 1
+        CONFIG_CACHE.pop(int(guild_id), None)
+
+# string stat: hits or misses
+# Returns a function reading the stat, for GAUGES
+def config_cache_stat(stat):
+    def read():
+        with CONFIG_LOCK:
+            return CONFIG_CACHE_STATS[stat]
+    return read
+
+GAUGES['eventbot_config_cache_hits'] = config_cache_stat('hits')
+GAUGES['eventbot_config_cache_misses'] = config_cache_stat('misses')
+
 # int guild_id: name of server to search for
 def guild_config_exists(guild_id):
     return bool(CONFIG.find({"ID": guild_id}).limit(1).count())
@@ -182,6 +769,7 @@ def guild_config_exists(guild_id):
 def new_guild_config(guild_id):
     guild = {"ID": guild_id}
     CONFIG.insert_one(guild)
+    invalidate_config(guild_id)
 
 
 # ==== Helper Functions: Permissions ====
@@ -202,6 +790,7 @@ def set_admin_level(guild_id, level):
 
     config_id = config_to_id(guild_id)
     update_field(config_id, 'Admin', level, collection=CONFIG)
+    invalidate_config(guild_id)
     info('Admin level set to: {} ({})'.format(level, guild_id))
     return True
 
@@ -216,11 +805,13 @@ def is_admin(ctx):
 
 # Context ctx: context of command which calls this function
 # string name: name of event to check authorship of
-def is_author(ctx, name):
-    collection = get_collection(ctx.message.guild.id)
-    if not event_exists(name, collection): 
+# event: event entry in mongodb if already fetched by the caller
+def is_author(ctx, name, event=None):
+    if event is None:
+        collection = get_collection(ctx.message.guild.id)
+        event = find_event(name, collection, {'Author': 1})
+    if event is None: 
         return False
-    event = get_event(name, collection)
     msg_author = ctx.message.author.name + '#' + ctx.message.author.discriminator
     return msg_author == event['Author']
 
@@ -233,8 +824,9 @@ def pprint_insufficient_privileges():
 
 # datetime time: time to search for conflicts
 def time_exists(time, collection=EVENTS):
-    events = collection.find({"Time": time})
-    return events.count()
+    if any(rule_occurs_at(rule, time) for rule in get_rules(collection.name)):
+        return True
+    return collection.count_documents({"Time": time}, limit=1)
 
 # datetime time: time to determine if it is in the past
 def is_past(time):
@@ -253,15 +845,16 @@ def pprint_time(time, tz=DEFAULT_TZ):
     return msg
 
 # int guild_id: guild_id of server to set timezone for
-# timezone: timezone matching VALID_TZ
+# timezone: timezone in valid_timezones()
 def set_timezone(guild_id, timezone):
-    if timezone not in VALID_TZ:
+    if timezone not in valid_timezones():
         return False
     if not guild_config_exists(guild_id):
         new_guild_config(guild_id)
 
     config_id = config_to_id(guild_id)
     update_field(config_id, 'Timezone', timezone, collection=CONFIG)
+    invalidate_config(guild_id)
     info('Server set to timezone: {}'.format(timezone))
     return True
 
@@ -275,30 +868,92 @@ def get_timezone(guild_id):
 
 # string inp: user datetime input
 def input_to_datetime(inp, tz=DEFAULT_TZ):
-    time = parse(inp)
-    bot_localtime = datetime.datetime.now(tz)
-
-    if time.tzinfo is None: #or time.tzinfo.utcoffset(time) is None:
-        time = tz.localize(time)
+    # Relative dates are resolved against the bot's local date, as dateparser does
+    time = parse_datetime(inp, tz, datetime.date.today())
+    if time is None:
+        # Not cached: dateparser also reads inputs relative to the current time, like "in 2 hours"
+        from dateparser import parse # slow to import, only load it when it is needed
+        time = parse(inp)
+        if time.tzinfo is None: #or time.tzinfo.utcoffset(time) is None:
+            time = tz.localize(time)
     return time
 
+# Inputs are almost always [date] time, where date is M/D, M/D/Y, today or tomorrow and
+# time is H:MM, H:MMam or Ham. These are parsed here, anything else goes to dateparser.
+DATETIME_PATTERN = re.compile(r'''
+    ^\s*
+    (?:(?:(?P<month>\d{1,2})/(?P<day>\d{1,2})(?:/(?P<year>\d{2}|\d{4}))?|(?P<relative>today|tomorrow))\s+)?
+    (?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<meridiem>am|pm)?
+    \s*$''', re.IGNORECASE | re.VERBOSE)
+
+# string inp: user datetime input
+# date today: date relative dates in inp are relative to
+# Returns naive datetime, or None if inp is not in one of the formats in DATETIME_PATTERN
+def fast_parse_datetime(inp, today):
+    match = DATETIME_PATTERN.match(inp)
+    if match is None:
+        return None
+    fields = match.groupdict()
+    if fields['minute'] is None and fields['meridiem'] is None:
+        return None # a bare number is not a time
+
+    hour = int(fields['hour'])
+    minute = int(fields['minute'] or 0)
+    if fields['meridiem']:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if fields['meridiem'].lower() == 'pm' else 0)
+
+    date = today
+    if fields['relative'] and fields['relative'].lower() == 'tomorrow':
+        date = today + datetime.timedelta(days=1)
+    try:
+        if fields['month']:
+            year = int(fields['year'] or today.year)
+            if year < 100:
+                year += 2000
+            date = datetime.date(year, int(fields['month']), int(fields['day']))
+        return datetime.datetime.combine(date, datetime.time(hour, minute))
+    except ValueError:
+        return None # out of range, leave it to dateparser
+
+# string inp: user datetime input
+# timezone tz: timezone of the guild
+# date today: part of the cache key, so relative dates are not remembered past midnight
+# Returns timezone aware datetime, or None if inp is not in one of the formats in DATETIME_PATTERN
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_datetime(inp, tz, today):
+    time = fast_parse_datetime(inp, today)
+    if time is None:
+        return None
+    return tz.localize(time)
+
 
 # ==== Helper Functions: Events general ====
 
+# All event lookups go through here so each command only needs one round trip.
+# string name: name of event to search for
+# dict projection: fields to return, or None to return the whole event
+# Returns the event entry in mongodb, or None if there is no such event
+def find_event(name, collection, projection=None):
+    event = collection.find_one({'Name': name}, projection)
+    if WRITE_BEHIND and event is not None:
+        overlay_buffered(collection.name, event)
+    return event
+
 # string name: name of event to search for
 def event_exists(name, collection=EVENTS):
     if collection == EVENTS:
         warning("Falling back to default events collection!")
-    return bool(collection.find({"Name": name}).limit(1).count())
+    return find_event(name, collection, {'_id': 1}) is not None
 
 # string name: name of event to return
 def get_event(name, collection):
-    event = collection.find_one({'Name': name})
-    return event
+    return find_event(name, collection)
 
 # string name: name of event to find id of
 def get_event_id(name, collection):
-    event = collection.find_one({'Name': name})
+    event = find_event(name, collection, {'_id': 1})
     event_id = event['_id']
     return event_id
 
@@ -306,6 +961,16 @@ def get_event_id(name, collection):
 def user_to_username(user):
     return "{}#{}".format(user.name, user.discriminator)
 
+# User user: Return attendance entry for user, {'ID': user id, 'Name': username#discriminator}
+def user_entry(user):
+    return {'ID': user.id, 'Name': user_to_username(user)}
+
+# attendee: attendance entry, or username#discriminator string in events made before user ids were stored
+def attendee_name(attendee):
+    if isinstance(attendee, dict):
+        return attendee['Name']
+    return attendee
+
 # Client client: discord client in guild
 # string username: Return User object in guild matching username
 def username_to_user(client, username):
@@ -313,6 +978,19 @@ def username_to_user(client, username):
         if user.name + '#' + user.discriminator == username:
             return user
 
+# string user_key: key of a reminder, user id as string or username#discriminator in old events
+# Returns User object to send the reminder to, or None if the user cannot be found
+async def reminder_user(user_key):
+    if not user_key.isdigit():
+        return username_to_user(bot, user_key)
+    user = bot.get_user(int(user_key))
+    if user is None:
+        try:
+            user = await bot.get_user_info(int(user_key))
+        except discord.NotFound:
+            return None
+    return user
+
 # string emoji: reaction emoji from discord event
 def emoji_to_status(emoji):
     matched_status = ''
@@ -333,61 +1011,87 @@ def pprint_event_not_found(name):
     msg = "Warning: Cannot find event called {}.".format(name)
     return msg
 
+# string author: username#discriminator of user creating the event
+# int guild_id: guild the event belongs to
+# Returns new event entry, as stored in mongodb
+def make_event(name, author, time, description, guild_id):
+    event = {'Name': name,
+            'Author': author,
+            'Time': time,
+            'Description': description,
+            'Metadata': {"Reminders": {}, "GuildID": guild_id}
+    }
+
+    for status in STATUSES.keys():
+        event[status] = []
+    return event
+
 # context ctx: used to get discord guild name
 # string name: name of event to create
 # string datetime: string parseable by dateparser
 # string description: descrption of event
+# Returns (message to send, new event entry in mongodb or None if it was not created)
 def new_event(ctx, name, datetime, description='No description.'):
     guild_id = ctx.message.guild.id
     collection = get_collection(guild_id)
-    time = input_to_datetime(datetime, tz=get_timezone(guild_id))
     timezone = get_timezone(guild_id)
+    time = input_to_datetime(datetime, tz=timezone)
     author = ctx.message.author.name + '#' + ctx.message.author.discriminator
 
-    if event_exists(name, collection):
-        return name + " already exists in upcoming events."
+    if find_event(name, collection, {'_id': 1}):
+        return name + " already exists in upcoming events.", None
     elif is_past(time):
         warning("Failed to schedule event at {}".format(time))
-        return "The specified date/time occurred in the past."
+        return "The specified date/time occurred in the past.", None
     if time_exists(time, collection):
         warning("Failed to schedule event at {}".format(time))
-        return "There is already an event scheduled for {}".format(pprint_time(time))
-
-    event = {'Name': name,
-            'Author': author,
-            'Time': time,
-            'Description': description,
-            'Metadata': {"Reminders": {}, "GuildID": ctx.message.guild.id}
-    }
-
-    for status in STATUSES.keys():
-        event[status] = []
+        return "There is already an event scheduled for {}".format(pprint_time(time)), None
 
+    event = make_event(name, author, time, description, guild_id)
+    write_seq = render_write_seq()
     collection.insert_one(event)
 
-    msg = pprint_event(name, collection=collection) + pprint_attendance_instructions()
-    return msg 
+    msg = pprint_event(name, collection=collection, event=event, write_seq=write_seq) + pprint_attendance_instructions()
+    return msg, event
+
+# ObjectId event_id: _id of event to delete
+def remove_event(event_id, collection):
+    event = collection.find_one_and_delete({"_id": event_id}, projection={'Time': 1, 'Metadata.Link': 1, 'Metadata.Rule': 1})
+    if event:
+        unlink_event(event)
+        skip_occurrence(event, collection)
+    bump_event_version(event_id)
+    forget_event_version(event_id)
+    unschedule_event_reminders(collection.name, event_id)
+    forget_event_messages([event_id])
 
 # string name: name of event to delete
-def delete_event(name, collection):
-    if event_exists(name, collection):
-        result = collection.remove({"Name": name})
+# event: event entry in mongodb if already fetched by the caller
+def delete_event(name, collection, event=None):
+    if event is None:
+        event = find_event(name, collection, {'_id': 1})
+    if event:
+        remove_event(event['_id'], collection)
         msg = "Removed {}.".format(name)
     else:
         msg = pprint_event_not_found(name)
     return msg
 
+# event: event entry in mongodb to move, with Time and Metadata.Rule
+# datetime time: new start time of event
+def reschedule_event(event, time, collection):
+    skip_occurrence(event, collection)
+    update_field(event['_id'], 'Time', time, collection=collection)
+    event['Time'] = time
+    schedule_event_reminders(collection.name, event)
+
 # int guild_id: guild id whose events to delete
 def delete_past_events(guild_id):
     msg = ''
     collection = get_collection(guild_id)
 
-    cursor = collection.find({})
-    for event in cursor:
-        if is_past(event['Time']):
-            msg += "{} - {}\n".format(event['Name'], pprint_time(event['Time']))
-            delete_event(event['Name'], collection)
-            info("Deleted {}.".format(event['Name']))
+    for event in delete_events_before(collection, datetime.datetime.now(DEFAULT_TZ)):
+        msg += "{} - {}\n".format(event['Name'], pprint_time(event['Time']))
 
     if msg:
         msg = "The following past events were deleted: \n\n" + msg
@@ -395,183 +1099,1619 @@ def delete_past_events(guild_id):
         msg = "No past events were found."
     return msg
 
+# Delete every event of collection which started before cutoff, with one range query
+# to find them and one delete_many. An event rescheduled in between is left alone, and
+# only events which were actually deleted lose their reminders, messages and link.
+# datetime cutoff: events with an earlier Time are deleted
+# bool archive: copy the events to HISTORY before deleting them
+# Returns list of deleted events, with Name and Time, oldest first
+def delete_events_before(collection, cutoff, archive=False):
+    projection = None if archive else {'Name': 1, 'Time': 1, 'Metadata.Link': 1}
+    events = list(collection.find({'Time': {'$lt': cutoff}}, projection).sort('Time', ASCENDING))
+    if not events:
+        return []
+
+    event_ids = [event['_id'] for event in events]
+    if archive:
+        # Upserts, so running again after a failed delete does not archive anything twice
+        HISTORY.bulk_write([ReplaceOne({'_id': event['_id']}, event, upsert=True) for event in events], ordered=False)
+    result = collection.delete_many({'_id': {'$in': event_ids}, 'Time': {'$lt': cutoff}})
+    if result.deleted_count < len(event_ids):
+        # Some were rescheduled (or deleted by someone else) since they were found
+        kept = [event['_id'] for event in collection.find({'_id': {'$in': event_ids}}, {'_id': 1})]
+        if archive and kept:
+            HISTORY.delete_many({'_id': {'$in': kept}})
+        events = [event for event in events if event['_id'] not in kept]
+        event_ids = [event['_id'] for event in events]
+    for event in events:
+        unlink_event(event)
+    for event_id in event_ids:
+        bump_event_version(event_id)
+        forget_event_version(event_id)
+        unschedule_event_reminders(collection.name, event_id)
+    forget_event_messages(event_ids)
+    info("Deleted {} events which started before {}.".format(len(events), cutoff))
+    return events
+
+# Delete events of every guild which started more than EVENT_EXPIRY_HOURS ago.
+# A TTL index on Time would do this inside Mongo, but it would replace the plain
+# Time index, could not archive, and would leave reminders and messages behind.
+# Returns number of events deleted
+def prune_stale_events():
+    cutoff = datetime.datetime.now(DEFAULT_TZ) - datetime.timedelta(hours=EVENT_EXPIRY_HOURS)
+    return sum(len(delete_events_before(get_collection(guild_id), cutoff, ARCHIVE_EVENTS)) for guild_id in guild_ids())
+
+# int guild_id: guild id whose events created by !factory to delete
+def delete_test_events(guild_id):
+    collection = get_collection(guild_id)
+
+    cursor = collection.find({}, {'Name': 1})
+    for event in cursor:
+        if event['Name'].startswith('-test'):
+            remove_event(event['_id'], collection)
+
 # string name: name of event to pretty print
 # bool verbose: print only name and time if False
-def pprint_event(name, collection, verbose=True):
+# event: event entry in mongodb if already fetched by the caller
+# int write_seq: render_write_seq() from just before the caller fetched event, None to not cache the render
+def pprint_event(name, collection, verbose=True, event=None, write_seq=None):
     tz = get_timezone(int(str(collection.name)))
 
-    def pprint_raw_event(event, opposing=False):
-        msg = ''
-        for field in event:
-            val = event[field]
-            if field == "Name":
-                msg += "__**{}**__\n".format(val)                
-            elif field == "_id":
-                msg += ''
-            elif field == "Time":
-                msg += "**{}:** {}\n".format(field, pprint_time(val, tz=tz)) 
-            elif verbose:
-                
-                if field in STATUSES and isinstance(val, list):
-                    status = field
-                    if val:
-                        attendee_list = ', '.join(val)
-                    else:
-                        attendee_list = 'None yet!'
-                    msg += "{} **{} ({}):** {}\n".format(STATUSES[status][0], status, len(val), attendee_list)
-                elif opposing or field == 'Metadata':
-                    continue # do not show 
-                elif not val:
-                    msg += "**{}:** {}\n".format(field, 'None')
-                else:
-                    msg += "**{}:** {}\n".format(field, val)
-        return msg
-
-    if event_exists(name, collection) == False:
+    if event is None:
+        write_seq = render_write_seq()
+        event = find_event(name, collection)
+    if event is None:
         return pprint_event_not_found(name)
 
-    event = get_event(name, collection)
-    msg = pprint_raw_event(event)
+    key = render_key(event, tz, verbose)
+    msg = get_cached_render(key)
+    if msg is not None:
+        return msg
+
+    msg = pprint_raw_event(event, tz, verbose)
 
     if 'Link' in event['Metadata'] and verbose:
-        key = event['Metadata']['Link']
-        linked_event = get_linked_event(key)
-        if linked_event == None:
+        summary = event['Metadata'].get('LinkSummary')
+        if summary is None:
+            # Linked before summaries were kept
+            summary = refresh_link_summary(event, collection)
+        if summary is None or summary.get('Deleted'):
             msg += "**Former linked event has been deleted.**\n"
             msg += "**Link key:** `{} {}\n\n`".format(event['_id'], collection.name)
         else:
-            msg += "\n**Opposing team ({}) status: **\n".format(id_to_name(key[key.find(' ')+1:])) 
-            msg += pprint_raw_event(linked_event, opposing=True)
+            msg += "\n**Opposing team ({}) status: **\n".format(summary['Guild'])
+            msg += pprint_link_summary(summary)
     elif verbose:
         msg += "**Link key:** `{} {}\n\n`".format(event['_id'], collection.name)
 
-    return msg + '\n'
+    msg += '\n'
+    cache_render(key, msg, write_seq)
+    return msg
+
+# dict summary: Metadata.LinkSummary of a linked event
+def pprint_link_summary(summary):
+    return ''.join("{} **{}:** {}\n".format(emojis[0], status, summary['Counts'].get(status, 0))
+                   for status, emojis in STATUSES.items())
 
-# Guild guild: guild to print events for
-def pprint_all_events(guild_id):
-    msg = 'Showing all events. Use command `!show [event name]` for detailed info.\n\n'
-    found_events = ''
-    collection = get_collection(guild_id)
+# event: event entry in mongodb to pretty print
+# timezone tz: timezone to show times in
+# bool verbose: print only name and time if False
+def pprint_raw_event(event, tz, verbose=True):
+    msg = ''
+    for field in event:
+        val = event[field]
+        if field == "Name":
+            msg += "__**{}**__\n".format(val)                
+        elif field == "_id":
+            msg += ''
+        elif field == "Time":
+            msg += "**{}:** {}\n".format(field, pprint_time(val, tz=tz)) 
+        elif verbose:
+            
+            if field in STATUSES and isinstance(val, list):
+                status = field
+                if val:
+                    attendee_list = ', '.join(attendee_name(attendee) for attendee in val)
+                else:
+                    attendee_list = 'None yet!'
+                msg += "{} **{} ({}):** {}\n".format(STATUSES[status][0], status, len(val), attendee_list)
+            elif field == 'Metadata':
+                continue # do not show 
+            elif not val:
+                msg += "**{}:** {}\n".format(field, 'None')
+            else:
+                msg += "**{}:** {}\n".format(field, val)
+    return msg
 
-    cursor = collection.find({})
-    for event in cursor:
-        found_events += pprint_event(event['Name'], verbose=False, collection=collection)
+# int guild_id: guild to print events for
+# int page: page of events to print, starting from 1
+# Returns list of messages, each short enough to be sent to discord
+def pprint_all_events(guild_id, page=1):
+    collection = get_collection(guild_id)
+    tz = get_timezone(guild_id)
+    skip = (page - 1) * EVENTS_PER_PAGE
 
-    if not found_events:
-        msg = 'No events found.'
+    # One extra event is fetched to find out if there is a next page
+    present = datetime.datetime.now(DEFAULT_TZ)
+    cursor = collection.find({'Time': {'$gte': present}}, {'Name': 1, 'Time': 1}).sort('Time', ASCENDING).skip(skip).limit(EVENTS_PER_PAGE + 1)
+    entries = [pprint_raw_event(event, tz, verbose=False) + '\n' for event in cursor]
+
+    rules = get_rules(guild_id) if page == 1 else []
+    if not entries and not rules:
+        return ['No events found.' if page == 1 else 'No events on page {}.'.format(page)]
+    shown = min(len(entries), EVENTS_PER_PAGE)
+    if len(entries) > EVENTS_PER_PAGE:
+        entries = entries[:EVENTS_PER_PAGE]
+        entries.append('Use command `!show_all {}` to see more events.'.format(page + 1))
+    if rules:
+        entries.append('\n**Recurring events** (use `!show [name] [mm/dd]` for a later date):\n')
+        entries.extend(pprint_rule(rule) + '\n' for rule in rules)
+
+    if shown:
+        header = 'Showing events {}-{}'.format(skip + 1, skip + shown)
+        if rules:
+            header += ' and recurring events'
     else:
-        msg += found_events
-    return msg
+        header = 'No upcoming events, showing recurring events'
+
+    # Start a new message whenever the next entry would not fit
+    messages = []
+    msg = header + '. Use command `!show [event name]` for detailed info.\n\n'
+    for entry in entries:
+        if len(msg) + len(entry) > MESSAGE_LIMIT:
+            messages.append(msg)
+            msg = ''
+        msg += entry
+    messages.append(msg)
+    return messages
 
 # string event_name: name of event to change status of
-# string user: username#discriminator of user to change status of
+# User user: user to change status of
 # string status: new status
+# Returns the updated event entry in mongodb, or None if the event does not exist
 def set_attendance(event_name, user, status, collection=EVENTS):
-    if not event_exists(event_name, collection):
-        return pprint_event_not_found(event_name)
-    
-    if not isinstance(user, str):
-        user_name = user_to_username(user)
-    else:
-        user_name = user
+    if WRITE_BEHIND:
+        event = find_event(event_name, collection)
+        if event and buffer_write(collection.name, event['_id'], ['attendance', user_entry(user), status]):
+            overlay_buffered(collection.name, event)
+            legacy = legacy_attendees(event, [user_entry(user)])
+            if legacy:
+                buffer_write(collection.name, event['_id'], ['unlist', legacy])
+                drop_legacy_attendees(event, legacy)
+            update_link_summary(event)
+        return event
+
+    # Moving between statuses is a single server side update, so reactions
+    # arriving at the same time cannot overwrite each other
+    event = collection.find_one_and_update(
+        attendance_filter({'Name': event_name}, user.id, status),
+        attendance_update(user_entry(user), status),
+        return_document=ReturnDocument.AFTER)
+    if event:
+        bump_event_version(event['_id'])
+        legacy = legacy_attendees(event, [user_entry(user)])
+        if legacy:
+            collection.update_one({'_id': event['_id']}, legacy_attendance_update(legacy))
+            drop_legacy_attendees(event, legacy)
+        update_link_summary(event)
+        return event
+    # Either the event does not exist or the user already has this status
+    return collection.find_one({'Name': event_name})
+
+# ObjectId event_id: _id of event to change statuses of
+# list changes: (User, new status) pairs, applied in order
+# Returns (the updated event entry in mongodb, or None if the event does not exist,
+# render_write_seq() from just before it was fetched, to pass to pprint_event)
+def set_attendance_bulk(event_id, changes, collection):
+    if WRITE_BEHIND:
+        changed = [buffer_write(collection.name, event_id, ['attendance', user_entry(user), status])
+                   for user, status in changes]
+        write_seq = render_write_seq()
+        event = collection.find_one({'_id': event_id})
+        if event:
+            overlay_buffered(collection.name, event)
+            legacy = legacy_attendees(event, [user_entry(user) for user, _ in changes])
+            if legacy:
+                buffer_write(collection.name, event_id, ['unlist', legacy])
+                drop_legacy_attendees(event, legacy)
+            if any(changed):
+                update_link_summary(event)
+        return event, write_seq
+
+    requests = [UpdateOne(attendance_filter({'_id': event_id}, user.id, status), attendance_update(user_entry(user), status))
+                for user, status in changes]
+    result = collection.bulk_write(requests, ordered=True)
+    # Bumped before fetching, so the render of the event fetched after this write can be cached
+    if result.modified_count:
+        bump_event_version(event_id)
+    write_seq = render_write_seq()
+    event = collection.find_one({'_id': event_id})
+    if result.modified_count and event:
+        legacy = legacy_attendees(event, [user_entry(user) for user, _ in changes])
+        if legacy:
+            collection.update_one({'_id': event_id}, legacy_attendance_update(legacy))
+            drop_legacy_attendees(event, legacy)
+            bump_event_version(event_id)
+        update_link_summary(event)
+    return event, write_seq
+
+# dict query: mongodb filter matching the event
+# int user_id: id of user to change status of
+# string status: new status
+# Returns query which only matches if user does not have status yet, so they are never listed twice
+def attendance_filter(query, user_id, status):
+    query = dict(query)
+    query[status + '.ID'] = {'$ne': user_id}
+    return query
 
-    event = get_event(event_name, collection)
-    event_id = get_event_id(event_name, collection)
+# dict entry: attendance entry of user to change status of, see user_entry
+# string status: new status
+# Returns mongodb update which removes user from every other status and adds them to status.
+# Metadata.AttendanceVersion counts these updates, see update_link_summary.
+def attendance_update(entry, status):
+    return {
+        '$pull': {s: {'ID': entry['ID']} for s in STATUSES if s != status},
+        '$push': {status: entry},
+        '$inc': {'Metadata.AttendanceVersion': 1}
+    }
 
-    old_status = []
+# event: event entry in mongodb after an attendance change
+# list entries: attendance entries of the users whose status changed
+# Returns the names of those users which are still listed as username#discriminator strings,
+# as in events made before user ids were stored. attendance_update cannot remove them
+# in the same update, so they are removed with legacy_attendance_update after it.
+def legacy_attendees(event, entries):
+    names = {entry['Name'] for entry in entries}
+    return sorted({a for s in STATUSES for a in event.get(s, []) if isinstance(a, str) and a in names})
+
+# list names: username#discriminator strings to remove from every status
+def legacy_attendance_update(names):
+    return {'$pull': {s: {'$in': names} for s in STATUSES}}
+
+# event: event entry in mongodb, changed in place
+# list names: username#discriminator strings to remove from every status
+def drop_legacy_attendees(event, names):
     for s in STATUSES:
-        if user_name in event[s]:
-            if s == status:
-                return # no net change
-            event[s].remove(user_name)
-            old_status = [s, event[s]] 
+        if s in event:
+            event[s] = [a for a in event[s] if a not in names]
+
+
+# ==== Helper Functions: Render cache ====
+# Rendered pprint_event output, least recently used first. Entries are keyed by
+# the version of the event; every helper which writes to an event, including to the
+# link summary kept in it, bumps its version, so stale renders are never returned and age out.
+# A render is only stored if its event was not written to between fetching it and
+# storing the render, so an event fetched just before a write is never cached under
+# the version after that write. RECENT_WRITES remembers the latest writes for this.
+# Versions only count writes made by this process.
+EVENT_VERSIONS = {}
+RENDER_CACHE = collections.OrderedDict()
+RENDER_STATE = {'writes': 0}
+RECENT_WRITES = collections.deque(maxlen=1024)
+RENDER_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+RENDER_LOCK = threading.Lock()
+
+# ObjectId event_id: _id of event which was just written to
+def bump_event_version(event_id):
+    with RENDER_LOCK:
+        EVENT_VERSIONS[str(event_id)] = EVENT_VERSIONS.get(str(event_id), 0) + 1
+        RENDER_STATE['writes'] += 1
+        RECENT_WRITES.append((RENDER_STATE['writes'], str(event_id)))
+
+# Returns the number of event writes so far. Take it just before fetching an event
+# and pass it to pprint_event, so the render of the event can be cached.
+def render_write_seq():
+    with RENDER_LOCK:
+        return RENDER_STATE['writes']
+
+# ObjectId event_id: _id of event which was deleted
+def forget_event_version(event_id):
+    with RENDER_LOCK:
+        EVENT_VERSIONS.pop(str(event_id), None)
+
+# event: event entry in mongodb to be rendered
+# timezone tz: timezone times are shown in
+# bool verbose: verbose flag passed to pprint_event
+def render_key(event, tz, verbose):
+    event_id = str(event['_id'])
+    with RENDER_LOCK:
+        return (event_id, EVENT_VERSIONS.get(event_id, 0), str(tz), verbose)
+
+# tuple key: from render_key
+# Returns the cached render, or None
+def get_cached_render(key):
+    with RENDER_LOCK:
+        msg = RENDER_CACHE.get(key)
+        if msg is None:
+            RENDER_CACHE_STATS['misses'] += 1
+        else:
+            RENDER_CACHE_STATS['hits'] += 1
+            RENDER_CACHE.move_to_end(key)
+        return msg
 
-    if old_status:
-        update_field(event_id, old_status[0], old_status[1], collection)
+# tuple key: from render_key
+# string msg: rendered event
+# int write_seq: RENDER_STATE['writes'] before the event was fetched, None to not cache
+def cache_render(key, msg, write_seq):
+    if write_seq is None:
+        return
+    with RENDER_LOCK:
+        if RENDER_STATE['writes'] - write_seq > len(RECENT_WRITES):
+            return # too many writes since to tell if the event was one of them
+        for seq, event_id in reversed(RECENT_WRITES):
+            if seq <= write_seq:
+                break
+            if event_id == key[0]:
+                return
+        RENDER_CACHE[key] = msg
+        while len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+            RENDER_CACHE.popitem(last=False)
+            RENDER_CACHE_STATS['evictions'] += 1
+
+# string stat: hits, misses or evictions
+# Returns a function reading the stat, for GAUGES
+def render_cache_stat(stat):
+    def read():
+        with RENDER_LOCK:
+            return RENDER_CACHE_STATS[stat]
+    return read
+
+GAUGES['eventbot_render_cache_hits'] = render_cache_stat('hits')
+GAUGES['eventbot_render_cache_misses'] = render_cache_stat('misses')
+GAUGES['eventbot_render_cache_evictions'] = render_cache_stat('evictions')
+
+
+# ==== Helper Functions: Write-behind buffer ====
+# With WRITE_BEHIND set, attendance, reminder and link summary changes are applied to an
+# in-memory copy of the fields they touch and queued, instead of written straight away.
+# flush_writes writes the queue with one ordered bulk_write per collection every
+# WRITE_FLUSH_INTERVAL seconds, or sooner once WRITE_FLUSH_OPS changes are queued.
+# Every change is appended to WRITE_JOURNAL before it is queued, so it survives the process
+# crashing, and the journal only keeps changes which were not flushed yet. The journal is synced
+# to disk once per flush rather than once per change, so buffer_write never waits on the disk;
+# if the machine itself goes down, changes made since the last flush can be lost. replay_write_journal writes what is
+# left in it at the next startup, whether or not WRITE_BEHIND is still set. This only
+# recovers from a crash if WRITE_JOURNAL is on persistent storage. A Heroku dyno's
+# filesystem is wiped on every restart, so there only the flush at shutdown protects
+# buffered changes, and a crash loses up to WRITE_FLUSH_INTERVAL of them.
+# Reads of an event with buffered changes take the buffered fields from the in-memory copy,
+# see overlay_buffered. A copy is kept for one flush after its changes are written, so a
+# read which fetched the event just before a flush still sees them.
+#
+# Changes are lists, so they can be journaled as JSON:
+# ['attendance', attendance entry, status]: see attendance_update
+# ['unlist', names]: see legacy_attendance_update
+# ['set', field, value] / ['unset', field]: set or remove a Metadata field
+# ['link', counts, version]: see update_link_summary
+
+# Fields of an event changes can touch
+BUFFERED_PROJECTION = dict({status: 1 for status in STATUSES}, **{
+    'Metadata.Reminders': 1, 'Metadata.AttendanceVersion': 1, 'Metadata.LinkSummary': 1})
+
+# ((guild_id, event_id), change) not flushed yet, oldest first
+WRITE_QUEUE = []
+# (guild_id, event_id) -> {'Event': buffered fields, 'Pending': changes queued, 'Flushed': written by last flush}
+BUFFERED_EVENTS = {}
+WRITE_LOCK = threading.RLock()
+# Held for the whole of a flush, so two flushes never write or dequeue the same changes
+WRITE_FLUSH_LOCK = threading.Lock()
+WRITE_WAKEUP = asyncio.Event()
+WRITE_JOURNAL_FILE = [None]
+
+# Returns number of buffered changes not flushed yet
+def write_buffer_pending():
+    with WRITE_LOCK:
+        return len(WRITE_QUEUE)
+
+GAUGES['eventbot_write_buffer_pending'] = write_buffer_pending
+
+# dict event: event entry in mongodb, or buffered fields of one
+# string field: dotted field name
+# Returns (dict holding the field, last part of its name), creating dicts on the way
+def buffered_field(event, field):
+    parts = field.split('.')
+    for part in parts[:-1]:
+        event = event.setdefault(part, {})
+    return event, parts[-1]
+
+# dict event: buffered fields of an event
+# list change: see above
+# Applies change to event the way mongodb would. Returns True if event changed.
+def apply_change(event, change):
+    kind = change[0]
+    if kind == 'attendance':
+        _, entry, status = change
+        if any(isinstance(a, dict) and a.get('ID') == entry['ID'] for a in event.get(status, [])):
+            return False
+        for s in STATUSES:
+            event[s] = [a for a in event.get(s, []) if not (isinstance(a, dict) and a.get('ID') == entry['ID'])]
+        event[status].append(entry)
+        metadata = event.setdefault('Metadata', {})
+        metadata['AttendanceVersion'] = metadata.get('AttendanceVersion', 0) + 1
+    elif kind == 'unlist':
+        drop_legacy_attendees(event, change[1])
+    elif kind == 'set':
+        parent, name = buffered_field(event, change[1])
+        parent[name] = change[2]
+    elif kind == 'unset':
+        parent, name = buffered_field(event, change[1])
+        parent.pop(name, None)
+    elif kind == 'link':
+        _, counts, version = change
+        summary = event.setdefault('Metadata', {}).setdefault('LinkSummary', {})
+        if summary.get('Version', -1) >= version:
+            return False
+        summary.update({'Counts': counts, 'Version': version})
+    return True
+
+# ObjectId event_id: event change applies to
+# list change: see above
+# Returns the UpdateOne which makes change in mongodb
+def change_request(event_id, change):
+    kind = change[0]
+    if kind == 'attendance':
+        _, entry, status = change
+        return UpdateOne(attendance_filter({'_id': event_id}, entry['ID'], status), attendance_update(entry, status))
+    if kind == 'unlist':
+        return UpdateOne({'_id': event_id}, legacy_attendance_update(change[1]))
+    if kind == 'set':
+        return UpdateOne({'_id': event_id}, {'$set': {change[1]: change[2]}})
+    if kind == 'unset':
+        return UpdateOne({'_id': event_id}, {'$unset': {change[1]: ''}})
+    _, counts, version = change
+    return UpdateOne({'_id': event_id, 'Metadata.LinkSummary.Version': {'$not': {'$gte': version}}},
+                     {'$set': {'Metadata.LinkSummary.Counts': counts, 'Metadata.LinkSummary.Version': version}})
+
+# string guild_id: guild of the event
+# ObjectId event_id: _id of event to change
+# list change: see above
+# Returns True if the change was buffered and changed the event, False if it changed
+# nothing or the event does not exist
+def buffer_write(guild_id, event_id, change):
+    key = (str(guild_id), event_id)
+    fields = None
+    while 1:
+        with WRITE_LOCK:
+            buffered = BUFFERED_EVENTS.get(key)
+            if buffered is None and fields is not None:
+                buffered = BUFFERED_EVENTS[key] = {'Event': fields, 'Pending': 0, 'Flushed': False}
+            if buffered is not None:
+                changed = apply_change(buffered['Event'], change)
+                if not changed:
+                    return False
+                buffered['Pending'] += 1
+                buffered['Flushed'] = False
+                journal_change(key, change)
+                WRITE_QUEUE.append((key, change))
+                full = len(WRITE_QUEUE) >= WRITE_FLUSH_OPS
+                break
+        # Nothing buffered for the event, so the database has all of its changes
+        fields = get_collection(guild_id).find_one({'_id': event_id}, BUFFERED_PROJECTION)
+        if fields is None:
+            return False
+        fields.setdefault('Metadata', {}).setdefault('Reminders', {})
+
+    bump_event_version(event_id)
+    if full:
+        bot.loop.call_soon_threadsafe(WRITE_WAKEUP.set)
+    return True
 
-    if not old_status or (old_status and status != old_status[0]):
-        attendance_status = event[status] + [user_name]
-        update_field(event_id, status, attendance_status, collection)
+# string guild_id: guild of the event
+# event: event entry in mongodb, changed in place
+# Replaces the fields of event which have buffered changes with their buffered values
+# Returns event
+def overlay_buffered(guild_id, event):
+    with WRITE_LOCK:
+        buffered = BUFFERED_EVENTS.get((str(guild_id), event['_id']))
+        if buffered is None:
+            return event
+        fields = copy.deepcopy(buffered['Event'])
+    metadata = fields.pop('Metadata', {})
+    fields.pop('_id', None)
+    event.update(fields)
+    event.setdefault('Metadata', {}).update(metadata)
+    return event
 
-    return "Set **{}'s** status to **{}** for **{}**.".format(user_name, status, event_name)
+# tuple key: (guild_id, event_id) of the change
+# list change: see above
+def journal_change(key, change):
+    if WRITE_JOURNAL_FILE[0] is None:
+        WRITE_JOURNAL_FILE[0] = open(WRITE_JOURNAL, 'a', encoding='utf-8')
+    f = WRITE_JOURNAL_FILE[0]
+    f.write(json.dumps({'Guild': key[0], 'Event': str(key[1]), 'Change': change}) + '\n')
+    f.flush()
+
+# Sync everything appended to the journal so far to disk. Call with WRITE_FLUSH_LOCK held,
+# so rewrite_journal cannot close the file meanwhile, and without WRITE_LOCK held.
+def sync_journal():
+    with WRITE_LOCK:
+        f = WRITE_JOURNAL_FILE[0]
+    if f is not None:
+        os.fsync(f.fileno())
+
+# Rewrite the journal with the changes still queued. Call with WRITE_LOCK held.
+# The new journal is synced by the next sync_journal.
+def rewrite_journal():
+    if WRITE_JOURNAL_FILE[0] is not None:
+        WRITE_JOURNAL_FILE[0].close()
+        WRITE_JOURNAL_FILE[0] = None
+    temp = WRITE_JOURNAL + '.tmp'
+    f = open(temp, 'w', encoding='utf-8')
+    for key, change in WRITE_QUEUE:
+        f.write(json.dumps({'Guild': key[0], 'Event': str(key[1]), 'Change': change}) + '\n')
+    f.flush()
+    os.replace(temp, WRITE_JOURNAL)
+    # Still the journal after the rename, so journal_change appends to it
+    WRITE_JOURNAL_FILE[0] = f
+
+# list changes: ((guild_id, event_id), change) to write, in order
+def write_changes(changes):
+    # Updates select events by _id, so the shared collection takes every guild's in one bulk_write
+    requests = collections.OrderedDict()
+    for (guild_id, event_id), change in changes:
+        target = 'single' if STORAGE_MODE == 'single' else guild_id
+        requests.setdefault(target, (guild_id, []))[1].append(change_request(event_id, change))
+    for guild_id, guild_requests in requests.values():
+        get_collection(guild_id).bulk_write(guild_requests, ordered=True)
+
+# bool retain: keep buffered fields for one more flush, see above. Helpers which write
+#              buffered fields directly flush with retain=False first.
+# Returns number of changes written
+def flush_writes(retain=True):
+    with WRITE_FLUSH_LOCK:
+        with WRITE_LOCK:
+            changes = list(WRITE_QUEUE)
+        if changes:
+            # One sync for every change journaled since the last flush
+            sync_journal()
+            # Changes only match if they are not applied yet, so writing them again after a failure is safe
+            write_changes(changes)
+
+        # Only buffer_write adds to WRITE_QUEUE while the flush lock is held, and only at the end,
+        # so the first len(changes) entries are still the ones just written
+        written = collections.Counter(key for key, _ in changes)
+        with WRITE_LOCK:
+            del WRITE_QUEUE[:len(changes)]
+            for key, buffered in list(BUFFERED_EVENTS.items()):
+                buffered['Pending'] -= written[key]
+                if buffered['Pending'] > 0:
+                    continue
+                if buffered['Flushed'] or not retain:
+                    del BUFFERED_EVENTS[key]
+                else:
+                    buffered['Flushed'] = True
+            if changes:
+                rewrite_journal()
+        return len(changes)
+
+# Write changes left in the journal by a previous run. Call before anything is buffered.
+# Returns number of changes written
+def replay_write_journal():
+    if WRITE_BEHIND and 'DYNO' in environ:
+        warning("WRITE_JOURNAL is on the dyno's filesystem, which does not survive a restart.")
+    if not os.path.exists(WRITE_JOURNAL) or not os.path.getsize(WRITE_JOURNAL):
+        return 0
+    changes = []
+    with open(WRITE_JOURNAL, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue # cut off by the restart
+            changes.append(((entry['Guild'], ObjectId(entry['Event'])), entry['Change']))
+    if changes:
+        write_changes(changes)
+        info("Replayed {} buffered writes from {}.".format(len(changes), WRITE_JOURNAL))
+    with WRITE_LOCK:
+        rewrite_journal()
+    return len(changes)
 
 
 # ==== Helper Functions: Reminders ====
 
+# Reminders are stored in the event's Metadata.Reminders, keyed by user id as a string:
+# {'Name': username#discriminator, 'Minutes': minutes before the event}. Events made
+# before user ids were stored use username#discriminator -> minutes instead.
+
 # string event_name: name of event to set reminder for
-# string user: username#discriminator of user to set reminder for
+# User user: user to set reminder for
 # int/float time: minutes before event begins to send reminders
-def set_reminder(event_name, user, time=REMINDER_TIME, collection=EVENTS):
-    if not event_exists(event_name, collection):
+# event: event entry in mongodb with Time, if already fetched by the caller
+def set_reminder(event_name, user, time=REMINDER_TIME, collection=EVENTS, event=None):
+    if event is None:
+        event = find_event(event_name, collection, {'Time': 1})
+    if event is None:
         return pprint_event_not_found(event_name)
-    
-    if not isinstance(user, str):
-        user_name = user_to_username(user)
-    else:
-        user_name = user
 
-    event = get_event(event_name, collection)
     event_id = event['_id']
-
-    metadata = event['Metadata']
-    metadata['Reminders'][user_name] = time
-    
-    update_field(event_id, 'Metadata', metadata, collection)
+    user_key = str(user.id)
+
+    reminder = {'Name': user_to_username(user), 'Minutes': time}
+    # Events made before user ids were stored key reminders by username#discriminator
+    legacy_key = user_to_username(user)
+    if '.' in legacy_key or legacy_key.startswith('$'):
+        legacy_key = None # could not have been stored as a key
+    if WRITE_BEHIND:
+        buffer_write(collection.name, event_id, ['set', 'Metadata.Reminders.' + user_key, reminder])
+        if legacy_key:
+            buffer_write(collection.name, event_id, ['unset', 'Metadata.Reminders.' + legacy_key])
+    else:
+        update = {'$set': {'Metadata.Reminders.' + user_key: reminder}}
+        if legacy_key:
+            update['$unset'] = {'Metadata.Reminders.' + legacy_key: ''}
+        collection.update_one({'_id': event_id}, update)
+        bump_event_version(event_id)
+    if legacy_key:
+        unschedule_reminder(collection.name, event_id, legacy_key)
+    SENT_REMINDERS.discard((str(collection.name), event_id, user_key)) # a new reminder, to be sent
+    schedule_reminder(collection.name, event_id, user_key, event['Time'] - datetime.timedelta(minutes=time))
     return "Set {} minutes reminder for **{}**.".format(time, event_name)
 
 # event: event entry in mongodb
-# string username: user.name#user.discriminator
-def delete_reminder(event, username, collection=EVENTS):
-    event_id = get_event_id(event['Name'], collection)
-    metadata = event['Metadata']
-    del metadata['Reminders'][username] 
-    update_field(event_id, 'Metadata', metadata, collection)
+# string user_key: key of reminder to delete, see set_reminder
+def delete_reminder(event, user_key, collection=EVENTS):
+    event_id = event['_id']
+    if WRITE_BEHIND:
+        buffer_write(collection.name, event_id, ['unset', 'Metadata.Reminders.' + user_key])
+    else:
+        collection.update_one({'_id': event_id}, {'$unset': {'Metadata.Reminders.' + user_key: ''}})
+        bump_event_version(event_id)
+    unschedule_reminder(collection.name, event_id, user_key)
+
+# reminder: value stored in Metadata.Reminders
+# Returns minutes before the event the reminder is sent
+def reminder_minutes(reminder):
+    if isinstance(reminder, dict):
+        return reminder['Minutes']
+    return reminder
+
+
+# ==== Reminder scheduler ====
+# Pending reminders are kept in memory in a min-heap ordered by send time, so the
+# background task only wakes up when a reminder is actually due.
+# Heap entries are (fire_time, seq, (guild_id, event_id, user_name)). REMINDER_INDEX
+# maps (guild_id, event_id) -> {user_name: fire_time} and is the source of truth:
+# heap entries which no longer match it are stale and are skipped.
+
+REMINDER_HEAP = []
+REMINDER_INDEX = {}
+REMINDER_SEQ = itertools.count()
+REMINDER_WAKEUP = asyncio.Event()
+# Helpers which change the schedule run on DB_EXECUTOR threads
+REMINDER_LOCK = threading.RLock()
+
+# string guild_id: name of the guild collection containing the event
+# ObjectId event_id: _id of event to send reminder for
+# string user_name: username#discriminator of user to remind
+# datetime fire_time: time at which the reminder should be sent
+def schedule_reminder(guild_id, event_id, user_name, fire_time):
+    key = (str(guild_id), event_id)
+    with REMINDER_LOCK:
+        REMINDER_INDEX.setdefault(key, {})[user_name] = fire_time
+        entry = (fire_time, next(REMINDER_SEQ), key + (user_name,))
+        heapq.heappush(REMINDER_HEAP, entry)
+        earliest = REMINDER_HEAP[0] is entry
+    if earliest:
+        # New earliest reminder, wake up the sender so it can sleep less
+        bot.loop.call_soon_threadsafe(REMINDER_WAKEUP.set)
+
+# string guild_id: name of the guild collection containing the event
+# ObjectId event_id: _id of event whose reminder to cancel
+# string user_name: username#discriminator of user whose reminder to cancel
+def unschedule_reminder(guild_id, event_id, user_name):
+    key = (str(guild_id), event_id)
+    with REMINDER_LOCK:
+        pending = REMINDER_INDEX.get(key, {})
+        pending.pop(user_name, None)
+        if not pending:
+            REMINDER_INDEX.pop(key, None)
+
+# string guild_id: name of the guild collection containing the event
+# ObjectId event_id: _id of event whose reminders to cancel
+def unschedule_event_reminders(guild_id, event_id):
+    with REMINDER_LOCK:
+        REMINDER_INDEX.pop((str(guild_id), event_id), None)
+
+# string guild_id: name of the guild collection containing the event
+# event: event entry in mongodb, replaces any reminders already scheduled for it
+def schedule_event_reminders(guild_id, event):
+    with REMINDER_LOCK:
+        unschedule_event_reminders(guild_id, event['_id'])
+        for user_key, reminder in event['Metadata']['Reminders'].items():
+            fire_time = event['Time'] - datetime.timedelta(minutes=reminder_minutes(reminder))
+            schedule_reminder(guild_id, event['_id'], user_key, fire_time)
+
+# Build the schedule from the database. Only needs to run once at startup.
+def load_reminders():
+    count = 0
+    query = {'Metadata.Reminders': {'$ne': {}}}
+    for guild_id, event in find_all_guild_events(query, {'Time': 1, 'Metadata.Reminders': 1}):
+        schedule_event_reminders(guild_id, event)
+        count += len(event['Metadata']['Reminders'])
+    info("Loaded {} pending reminders.".format(count))
+
+# Return list of (guild_id, event_id, user_name) whose reminders are due, removing them from the schedule
+def pop_due_reminders():
+    present = datetime.datetime.now(DEFAULT_TZ)
+    due = []
+    with REMINDER_LOCK:
+        while REMINDER_HEAP and REMINDER_HEAP[0][0] <= present:
+            fire_time, _, (guild_id, event_id, user_name) = heapq.heappop(REMINDER_HEAP)
+            if REMINDER_INDEX.get((guild_id, event_id), {}).get(user_name) != fire_time:
+                continue # cancelled or rescheduled
+            unschedule_reminder(guild_id, event_id, user_name)
+            due.append((guild_id, event_id, user_name))
+            observe('eventbot_reminder_lateness_seconds', {}, (present - fire_time).total_seconds())
+    return due
+
+# Returns number of reminders scheduled but not sent yet
+def reminder_backlog():
+    with REMINDER_LOCK:
+        return sum(len(pending) for pending in REMINDER_INDEX.values())
+
+GAUGES['eventbot_reminder_backlog'] = reminder_backlog
+
+# Return seconds until the next pending reminder is due, or None if there are none
+def seconds_until_next_reminder():
+    with REMINDER_LOCK:
+        while REMINDER_HEAP:
+            fire_time, _, (guild_id, event_id, user_name) = REMINDER_HEAP[0]
+            if REMINDER_INDEX.get((guild_id, event_id), {}).get(user_name) == fire_time:
+                present = datetime.datetime.now(DEFAULT_TZ)
+                return max(0.0, (fire_time - present).total_seconds())
+            heapq.heappop(REMINDER_HEAP) # drop stale entry
+    return None
+
+# list due: (guild_id, event_id, user_key) as returned by pop_due_reminders
+# Returns {(guild_id, event_id): event entry in mongodb with Name and Metadata.Reminders},
+# fetched with one query per guild. Deleted events are left out.
+def find_reminder_events(due):
+    event_ids = collections.defaultdict(set)
+    for guild_id, event_id, _ in due:
+        event_ids[guild_id].add(event_id)
+
+    events = {}
+    for guild_id, ids in event_ids.items():
+        cursor = get_collection(guild_id).find({'_id': {'$in': list(ids)}}, {'Name': 1, 'Metadata.Reminders': 1})
+        for event in cursor:
+            if WRITE_BEHIND:
+                overlay_buffered(guild_id, event)
+            events[(guild_id, event['_id'])] = event
+    return events
+
+# list done: (guild_id, event_id, user_key) of reminders which were sent or failed for good
+# list failures: documents describing reminders which could not be sent, stored in FAILED_REMINDERS
+# Removes the reminders from their events with one bulk write per guild
+def acknowledge_reminders(done, failures=()):
+    if WRITE_BEHIND:
+        for guild_id, event_id, user_key in done:
+            buffer_write(guild_id, event_id, ['unset', 'Metadata.Reminders.' + user_key])
+        if failures:
+            FAILED_REMINDERS.insert_many(list(failures))
+        return
+
+    unsets = collections.defaultdict(dict)
+    for guild_id, event_id, user_key in done:
+        unsets[(guild_id, event_id)]['Metadata.Reminders.' + user_key] = ''
+
+    requests = collections.defaultdict(list)
+    for (guild_id, event_id), unset in unsets.items():
+        requests[guild_id].append(UpdateOne({'_id': event_id}, {'$unset': unset}))
+    for guild_id, guild_requests in requests.items():
+        get_collection(guild_id).bulk_write(guild_requests, ordered=False)
+    for guild_id, event_id in unsets:
+        bump_event_version(event_id)
+
+    if failures:
+        FAILED_REMINDERS.insert_many(list(failures))
 
 
 # ==== Helper Functions: Event Linking ====
+# Each side of a link keeps Metadata.LinkSummary, a summary of the other side:
+# {'Guild': guild name, 'Counts': {status: attendees}, 'Version': AttendanceVersion
+# the counts were taken at}, with 'Deleted': True once the other side is deleted.
+# Whenever attendance changes the other side's summary is updated with one $set,
+# so showing a linked event never reads the other guild's collection.
+
+# Fields needed to summarize an event for the other side of its link
+LINK_SUMMARY_PROJECTION = dict({status: 1 for status in STATUSES}, **{'Metadata.AttendanceVersion': 1})
+
+# event: event entry in mongodb, with its statuses and Metadata.AttendanceVersion
+# string guild_id: guild of event
+# Returns the LinkSummary to store in the event linked to event
+def link_summary(event, guild_id):
+    guild = id_to_name(guild_id)
+    return {'Guild': guild.name if guild else str(guild_id),
+            'Counts': {status: len(event.get(status, [])) for status in STATUSES},
+            'Version': event.get('Metadata', {}).get('AttendanceVersion', 0)}
+
+# event: event entry in mongodb whose attendance just changed, with Metadata
+# Copies the attendance counts of event into the summary kept by the event linked to it.
+# Summaries are only replaced by newer ones, so updates which finish out of order are harmless.
+def update_link_summary(event):
+    link = event['Metadata'].get('Link')
+    if not link:
+        return
+    linked_id, guild_id = link.split()
+    version = event['Metadata'].get('AttendanceVersion', 0)
+    counts = {status: len(event.get(status, [])) for status in STATUSES}
+    if WRITE_BEHIND:
+        buffer_write(guild_id, ObjectId(linked_id), ['link', counts, version])
+        return
+    get_collection(guild_id).update_one(
+        {'_id': ObjectId(linked_id), 'Metadata.LinkSummary.Version': {'$not': {'$gte': version}}},
+        {'$set': {'Metadata.LinkSummary.Counts': counts, 'Metadata.LinkSummary.Version': version}})
+    bump_event_version(linked_id)
+
+# event: deleted event entry in mongodb, with Metadata.Link
+# Tells the event linked to event, if any, that its other side is gone
+def unlink_event(event):
+    link = event.get('Metadata', {}).get('Link')
+    if not link:
+        return
+    linked_id, guild_id = link.split()
+    if WRITE_BEHIND:
+        buffer_write(guild_id, ObjectId(linked_id), ['set', 'Metadata.LinkSummary.Deleted', True])
+        return
+    get_collection(guild_id).update_one({'_id': ObjectId(linked_id)}, {'$set': {'Metadata.LinkSummary.Deleted': True}})
+    bump_event_version(linked_id)
+
+# event: event entry in mongodb linked before summaries were kept
+# Reads the linked event once and stores its summary in event
+# Returns the summary, or None if the linked event was deleted
+def refresh_link_summary(event, collection):
+    if WRITE_BEHIND:
+        flush_writes(retain=False)
+    key = event['Metadata']['Link']
+    linked_event = get_linked_event(key, LINK_SUMMARY_PROJECTION)
+    summary = None if linked_event is None else link_summary(linked_event, key.split()[1])
+    collection.update_one({'_id': event['_id']}, {'$set': {'Metadata.LinkSummary': summary or {'Deleted': True}}})
+    bump_event_version(event['_id'])
+    return summary
+
+# string event_name: name of event in collection to link
+# string key: link key of the other event, "[event id] [guild id]"
 def set_link(event_name, key, collection):
-    if not event_exists(event_name, collection):
+    if WRITE_BEHIND:
+        flush_writes(retain=False)
+    event = find_event(event_name, collection, LINK_SUMMARY_PROJECTION)
+    if event is None:
         return pprint_event_not_found(event_name)
-
-    # Update first event
-    event = get_event(event_name, collection)
     event_id = event['_id']
+    own_key = "{} {}".format(event_id, collection.name)
 
-    metadata = event['Metadata']
-    metadata['Link'] = key
-
-    update_field(event_id, 'Metadata', metadata, collection=collection)
-
-    # Update second event
+    # Link the other event to this one, reading its attendance in the same round trip
     event2_id, guild_id = key.split()
-    key = "{} {}".format(event_id, collection.name)
-    collection = get_collection(guild_id)
-    event = collection.find_one({'_id': ObjectId(event2_id)})
-
-    metadata = event['Metadata']
-    metadata['Link'] = key
-
-    update_field(ObjectId(event2_id), 'Metadata', metadata, collection=collection)
-
-    return "Established link with key {}".format(key)
-
-def get_linked_event(key):
+    event2 = get_collection(guild_id).find_one_and_update(
+        {'_id': ObjectId(event2_id)},
+        {'$set': {'Metadata.Link': own_key, 'Metadata.LinkSummary': link_summary(event, collection.name)}},
+        projection=LINK_SUMMARY_PROJECTION)
+    if event2 is None:
+        return "Warning: Cannot find event with link key {}.".format(key)
+    bump_event_version(event2_id)
+
+    collection.update_one({'_id': event_id},
+                          {'$set': {'Metadata.Link': key, 'Metadata.LinkSummary': link_summary(event2, guild_id)}})
+    bump_event_version(event_id)
+
+    return "Established link with key {}".format(own_key)
+
+# string key: link key, "[event id] [guild id]"
+# dict projection: fields to read
+def get_linked_event(key, projection=None):
     event_id, guild_id = key.split()
     collection = get_collection(guild_id)
-    event = collection.find_one({'_id': ObjectId(event_id)})
+    event = collection.find_one({'_id': ObjectId(event_id)}, projection)
     return event
 
+# Returns (message to send, new event entry in mongodb or None if it was not created)
 def join_event(ctx, key):
     event = get_linked_event(key)
+    if event is None:
+        return "Warning: Cannot find event with link key {}.".format(key), None
     name = event['Name']
     datetime = event['Time']
     description = event['Description']
-    event_new = new_event(ctx, name, str(datetime), description)
+    msg, event_new = new_event(ctx, name, str(datetime), description)
+    if event_new is None:
+        return msg, None
 
     collection = get_collection(ctx.message.guild.id)
     set_link(name, key, collection)
 
-    return pprint_event(name, collection=collection) + pprint_attendance_instructions() 
+    return pprint_event(name, collection=collection) + pprint_attendance_instructions(), event_new
+
+
+# ==== Helper Functions: Storage migration ====
+
+# Copy every per guild collection into the shared events collection, in batches.
+# Progress is saved after each batch, so an interrupted migration resumes where it
+# stopped. Copies are upserts by _id, so running it again is safe. Before switching, every
+# run ends by deleting events of the shared collection which are gone from their guild
+# collection, so events deleted since they were copied do not come back after switching.
+# bool restart: forget saved progress and copy everything again, e.g. to pick up
+#               changes made since the last run just before switching STORAGE_MODE
+# Returns ({guild_id: number of events copied}, number of copies deleted)
+def migrate_storage(restart=False, batch_size=MIGRATION_BATCH_SIZE):
+    if restart:
+        MIGRATIONS.delete_one({'_id': 'single_events'})
+    progress = MIGRATIONS.find_one({'_id': 'single_events'}) or {}
+    done = set(progress.get('Done', []))
+    resume = progress.get('Resume', {})
+    copied = {}
+
+    for guild_id in sorted(name for name in db.collection_names() if name.isdigit()):
+        if guild_id in done:
+            continue
+        source = get_guild_collection(guild_id)
+        last_id = resume.get(guild_id)
+        copied[guild_id] = 0
+
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id else {}
+            batch = list(source.find(query).sort('_id', ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            for event in batch:
+                event.setdefault('Metadata', {}).setdefault('GuildID', int(guild_id))
+            EVENTS.bulk_write([ReplaceOne({'_id': event['_id']}, event, upsert=True) for event in batch], ordered=False)
+            last_id = batch[-1]['_id']
+            copied[guild_id] += len(batch)
+            MIGRATIONS.update_one({'_id': 'single_events'}, {'$set': {'Resume.' + guild_id: last_id}}, upsert=True)
+
+        MIGRATIONS.update_one({'_id': 'single_events'}, {'$addToSet': {'Done': guild_id}}, upsert=True)
+        info("Migrated {} events from collection {}.".format(copied[guild_id], guild_id))
+
+    # Once switched, the shared collection is the one in use and must not be trimmed
+    removed = 0
+    if STORAGE_MODE != 'single':
+        guilds = [guild_id for guild_id in EVENTS.distinct('Metadata.GuildID') if guild_id is not None]
+        removed = sum(remove_deleted_copies(str(guild_id), batch_size) for guild_id in guilds)
+    return copied, removed
+
+# string guild_id: guild whose copies in the shared events collection to check
+# Deletes copies of events which no longer exist in the guild's own collection
+# Returns number of copies deleted
+def remove_deleted_copies(guild_id, batch_size=MIGRATION_BATCH_SIZE):
+    source = get_guild_collection(guild_id)
+    cursor = EVENTS.find({'Metadata.GuildID': int(guild_id)}, {'_id': 1}).batch_size(batch_size)
+    removed = 0
+    while True:
+        ids = [event['_id'] for event in itertools.islice(cursor, batch_size)]
+        if not ids:
+            break
+        kept = {event['_id'] for event in source.find({'_id': {'$in': ids}}, {'_id': 1})}
+        gone = [event_id for event_id in ids if event_id not in kept]
+        if gone:
+            removed += EVENTS.delete_many({'_id': {'$in': gone}}).deleted_count
+    if removed:
+        info("Deleted {} copies of events deleted from collection {}.".format(removed, guild_id))
+    return removed
+
+# Convert attendance and reminders stored by username#discriminator in older events to
+# entries with user ids, see user_entry and set_reminder. Users are matched against
+# the bot's user cache; names which match nobody are left as they are. Each event is
+# only updated if its attendance and reminders did not change since they were read,
+# so running it while the bot is in use is safe, and running it again picks up the rest.
+# dict users: username#discriminator -> User, defaults to every user the bot can see
+# Returns (number of events updated, number of names which matched nobody)
+def migrate_user_ids(users=None, batch_size=MIGRATION_BATCH_SIZE):
+    if WRITE_BEHIND:
+        flush_writes(retain=False)
+    if users is None:
+        users = {user_to_username(user): user for user in bot.users}
+    query = {'$or': [{status: {'$type': 'string'}} for status in STATUSES] + [{'Metadata.Reminders': {'$ne': {}}}]}
+    projection = dict({status: 1 for status in STATUSES}, Time=1, **{'Metadata.Reminders': 1})
+    requests = collections.defaultdict(list) # guild id -> pending updates
+    reminders_changed = False
+    updated = unmatched = 0
+
+    def flush(guild_id):
+        nonlocal updated
+        if requests[guild_id]:
+            result = get_collection(guild_id).bulk_write(requests.pop(guild_id), ordered=False)
+            updated += result.modified_count
+
+    for guild_id, event in find_all_guild_events(query, projection):
+        match = {'_id': event['_id']}
+        changes = {}
+
+        for status in STATUSES:
+            attendees = event.get(status)
+            if not isinstance(attendees, list) or not any(isinstance(a, str) for a in attendees):
+                continue
+            converted = []
+            for attendee in attendees:
+                if isinstance(attendee, str) and attendee in users:
+                    attendee = user_entry(users[attendee])
+                elif isinstance(attendee, str):
+                    unmatched += 1
+                converted.append(attendee)
+            match[status] = attendees
+            changes[status] = converted
+
+        reminders = event.get('Metadata', {}).get('Reminders', {})
+        if any(not key.isdigit() for key in reminders):
+            converted = {}
+            for key, reminder in reminders.items():
+                if not key.isdigit() and key in users:
+                    user = users[key]
+                    converted[str(user.id)] = {'Name': key, 'Minutes': reminder_minutes(reminder)}
+                else:
+                    unmatched += not key.isdigit()
+                    converted[key] = reminder
+            match['Metadata.Reminders'] = reminders
+            changes['Metadata.Reminders'] = converted
+            reminders_changed = True
+
+        if changes:
+            requests[guild_id].append(UpdateOne(match, {'$set': changes}))
+            bump_event_version(event['_id'])
+            if len(requests[guild_id]) >= batch_size:
+                flush(guild_id)
+
+    for guild_id in list(requests):
+        flush(guild_id)
+    if reminders_changed:
+        load_reminders() # reschedule under the new keys
+
+    info("Stored user ids in {} events, {} names matched no user.".format(updated, unmatched))
+    return updated, unmatched
+
+
+# ==== Helper Functions: Stats ====
+
+# Returns summary of the metrics for !stats. Percentiles are the upper bound of their histogram bucket.
+def pprint_stats():
+    def line(label, histogram):
+        return '{:<28}{:>7} {:>8} {:>8}'.format(label[:28], histogram.count,
+            pprint_seconds(histogram.quantile(0.5)), pprint_seconds(histogram.quantile(0.95)))
+
+    lines = ['{:<28}{:>7} {:>8} {:>8}'.format('', 'count', 'p50', 'p95')]
+    with METRICS_LOCK:
+        for key, histogram in sorted(HISTOGRAMS['eventbot_command_seconds'].items()):
+            lines.append(line('!' + dict(key)['command'], histogram))
+        for key, histogram in sorted(HISTOGRAMS['eventbot_handler_seconds'].items()):
+            lines.append(line(dict(key)['handler'], histogram))
+        # Database time by helper, busiest first
+        by_helper = collections.defaultdict(Histogram)
+        for key, histogram in HISTOGRAMS['eventbot_db_seconds'].items():
+            merged = by_helper[dict(key)['helper']]
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+        for helper, histogram in sorted(by_helper.items(), key=lambda item: -item[1].count)[:10]:
+            lines.append(line('db ' + helper, histogram))
+        reminders = {dict(key)['result']: value for key, value in COUNTERS['eventbot_reminders_total'].items()}
+        lateness = HISTOGRAMS['eventbot_reminder_lateness_seconds'].get(())
+
+    lines.append('')
+    lines.append('Reminders: {} pending, {} sent, {} failed'.format(
+        reminder_backlog(), reminders.get('sent', 0), reminders.get('failed', 0)))
+    if lateness:
+        lines.append('Reminder lateness p95: {}'.format(pprint_seconds(lateness.quantile(0.95))))
+    lines.append('Event loop lag: {}'.format(pprint_seconds(LOOP_LAG['last'])))
+    with CONFIG_LOCK:
+        lines.append('Config cache: {} hits, {} misses'.format(CONFIG_CACHE_STATS['hits'], CONFIG_CACHE_STATS['misses']))
+    with RENDER_LOCK:
+        lines.append('Render cache: {} hits, {} misses, {} evictions'.format(
+            RENDER_CACHE_STATS['hits'], RENDER_CACHE_STATS['misses'], RENDER_CACHE_STATS['evictions']))
+    return '\n'.join(lines)
+
+# float seconds: duration to print, or None
+def pprint_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>{}s'.format(METRICS_BUCKETS[-1])
+    if seconds < 1:
+        return '{:.0f}ms'.format(seconds * 1000)
+    return '{:.1f}s'.format(seconds)
+
+
+# ==== Helper Functions: Bulk import ====
+# !schedule_bulk reads rows of (line number, name, time, description) from a CSV or ICS
+# file. Rows are validated as they are read and checked against the database a batch
+# at a time, so an import takes a few round trips per BULK_IMPORT_BATCH_SIZE events.
+
+# file f: binary file object of a CSV with columns name, date, time, description.
+#         A header row naming the columns is optional; datetime may replace date and time.
+# Yields (line number, name, date/time string, description)
+def read_csv_events(f):
+    reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+    columns = ['name', 'date', 'time', 'description']
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        if reader.line_num == 1 and 'name' in [cell.strip().lower() for cell in row]:
+            columns = [cell.strip().lower() for cell in row]
+            continue
+        fields = dict(zip(columns, [cell.strip() for cell in row]))
+        when = fields.get('datetime') or '{} {}'.format(fields.get('date', ''), fields.get('time', '')).strip()
+        yield reader.line_num, fields.get('name', ''), when, fields.get('description') or 'No description.'
+
+# file f: binary file object of an iCalendar file
+# timezone tz: timezone of times which do not name one
+# Yields (line number, name, datetime, description) for every VEVENT
+def read_ics_events(f, tz):
+    def unescape(value):
+        return value.replace('\\n', '\n').replace('\\N', '\n').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+    def parse_start(params, value):
+        if 'VALUE=DATE' in params:
+            return tz.localize(datetime.datetime.strptime(value, '%Y%m%d'))
+        if value.endswith('Z'):
+            return pytz.utc.localize(datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ'))
+        time = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+        tzid = [param[5:] for param in params if param.startswith('TZID=')]
+        return pytz.timezone(tzid[0]).localize(time) if tzid else tz.localize(time)
+
+    def unfold(lines):
+        # Long lines continue on the next line after a space or tab
+        pending, start = None, 0
+        for number, line in enumerate(lines, 1):
+            line = line.rstrip('\r\n')
+            if line[:1] in (' ', '\t') and pending is not None:
+                pending += line[1:]
+                continue
+            if pending is not None:
+                yield start, pending
+            pending, start = line, number
+        if pending is not None:
+            yield start, pending
+
+    event = None
+    for number, line in unfold(io.TextIOWrapper(f, encoding='utf-8-sig')):
+        key, _, value = line.partition(':')
+        name, *params = key.upper().split(';')
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'line': number}
+        elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+            yield event['line'], event.get('name', ''), event.get('time'), event.get('description', 'No description.')
+            event = None
+        elif event is None:
+            continue
+        elif name == 'SUMMARY':
+            event['name'] = unescape(value).strip()
+        elif name == 'DESCRIPTION':
+            event['description'] = unescape(value).strip() or 'No description.'
+        elif name == 'DTSTART':
+            try:
+                event['time'] = parse_start(params, value.strip())
+            except (ValueError, pytz.UnknownTimeZoneError):
+                event['time'] = value # reported as invalid when the row is validated
+
+# int guild_id: guild to create the events in
+# string author: username#discriminator of user importing the events
+# rows: iterable of (line number, name, datetime or date/time string, description)
+# Returns (list of names of events created, list of messages about rows which were skipped)
+def import_events(guild_id, author, rows, tz=DEFAULT_TZ):
+    collection = get_collection(guild_id)
+    present = datetime.datetime.now(DEFAULT_TZ)
+    created, skipped = [], []
+    seen_names, seen_times = set(), set()
+
+    def validate(rows):
+        # Checks which need no database, done while the file is read
+        for count, (line, name, when, description) in enumerate(rows):
+            if count >= BULK_IMPORT_MAX_EVENTS:
+                skipped.append('Line {}: only the first {} events are imported.'.format(line, BULK_IMPORT_MAX_EVENTS))
+                return
+            if not name:
+                skipped.append('Line {}: missing name.'.format(line))
+                continue
+            time = when
+            if not isinstance(when, datetime.datetime):
+                try:
+                    time = input_to_datetime(str(when), tz)
+                except Exception:
+                    time = None
+            if not isinstance(time, datetime.datetime):
+                skipped.append('Line {}: cannot read time "{}" of {}.'.format(line, when, name))
+            elif time < present:
+                skipped.append('Line {}: {} is in the past.'.format(line, name))
+            elif name in seen_names or time in seen_times:
+                skipped.append('Line {}: {} has the same name or time as an earlier line.'.format(line, name))
+            else:
+                seen_names.add(name)
+                seen_times.add(time)
+                yield line, make_event(name, author, time, description, guild_id)
+
+    rules = get_rules(guild_id)
+    valid = validate(rows)
+    while True:
+        batch = list(itertools.islice(valid, BULK_IMPORT_BATCH_SIZE))
+        if not batch:
+            break
+        query = {'$or': [{'Name': {'$in': [event['Name'] for _, event in batch]}},
+                         {'Time': {'$in': [event['Time'] for _, event in batch]}}]}
+        taken = list(collection.find(query, {'Name': 1, 'Time': 1}))
+        names = {event['Name'] for event in taken}
+        times = {event['Time'] for event in taken}
+
+        events = []
+        for line, event in batch:
+            if event['Name'] in names:
+                skipped.append('Line {}: {} already exists.'.format(line, event['Name']))
+            elif event['Time'] in times or any(rule_occurs_at(rule, event['Time']) for rule in rules):
+                skipped.append('Line {}: there is already an event at {}.'.format(line, pprint_time(event['Time'], tz)))
+            else:
+                events.append(event)
+        if not events:
+            continue
+
+        try:
+            collection.insert_many(events, ordered=False)
+            created.extend(event['Name'] for event in events)
+        except BulkWriteError as e:
+            # Duplicate key errors mean it was created by someone else since the conflict check
+            errors = {error['index']: error for error in e.details['writeErrors']}
+            created.extend(event['Name'] for index, event in enumerate(events) if index not in errors)
+            for index, error in sorted(errors.items()):
+                if error.get('code') == 11000:
+                    skipped.append('{} already exists.'.format(events[index]['Name']))
+                else:
+                    skipped.append('{} could not be saved: {}'.format(events[index]['Name'], error.get('errmsg')))
+
+    info("Imported {} events into {}, skipped {}.".format(len(created), guild_id, len(skipped)))
+    return created, skipped
+
+# list created: names of events created
+# list skipped: messages about rows which were skipped
+def pprint_import_summary(created, skipped):
+    msg = "Imported **{}** events. Use command `!show_all` to see them.\n".format(len(created))
+    if skipped:
+        msg += "\nSkipped {} rows:\n".format(len(skipped))
+        for index, line in enumerate(skipped):
+            if len(msg) + len(line) + 40 > MESSAGE_LIMIT:
+                msg += "...and {} more.".format(len(skipped) - index)
+                break
+            msg += line + '\n'
+    return msg
+
+
+# ==== Helper Functions: Export ====
+# Events are read from a Time sorted cursor in batches and written out one at a time,
+# so an export never holds more than EXPORT_BATCH_SIZE events in memory.
+
+# int guild_id: guild to export events of
+# datetime start, end: only export events with start <= Time < end, None for no limit
+# dict projection: fields to read
+# Yields events, earliest first
+def iter_guild_events(guild_id, start=None, end=None, projection=None):
+    query = {}
+    if start or end:
+        query['Time'] = {}
+        if start:
+            query['Time']['$gte'] = start
+        if end:
+            query['Time']['$lt'] = end
+    cursor = get_collection(guild_id).find(query, projection).sort('Time', ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+    for event in cursor:
+        if WRITE_BEHIND:
+            overlay_buffered(guild_id, event)
+        yield event
+
+# string value: text to put in an ICS property
+def ics_escape(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+# string line: ICS content line
+# Returns line folded to lines of at most 75 octets, as ICS requires, ending in CRLF
+def ics_fold(line):
+    data = line.encode('utf-8')
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74 # continuation lines start with a space
+        while cut and (data[cut] & 0xC0) == 0x80:
+            cut -= 1 # do not split a character
+        parts.append(data[:cut])
+        data = data[cut:]
+    parts.append(data)
+    return '\r\n '.join(part.decode('utf-8') for part in parts) + '\r\n'
+
+# event: event entry in mongodb
+# Returns attendance of event as {status: [names]}
+def event_attendance(event):
+    return {status: [attendee_name(attendee) for attendee in event.get(status, [])] for status in STATUSES}
+
+# int guild_id: guild to export events of
+# string fmt: 'ics' or 'json' (one JSON object per line)
+# datetime start, end: see iter_guild_events
+# Yields the export a piece at a time
+def iter_export(guild_id, fmt='ics', start=None, end=None):
+    events = iter_guild_events(guild_id, start, end)
+    if fmt == 'json':
+        for event in events:
+            yield json.dumps({'ID': str(event['_id']), 'Name': event['Name'], 'Time': event['Time'].isoformat(),
+                              'Author': event.get('Author'), 'Description': event.get('Description'),
+                              'Attendance': event_attendance(event)}, ensure_ascii=False) + '\n'
+        return
+
+    stamp = datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//eventbot//{}//EN\r\n'.format(__version__)
+    for event in events:
+        attendance = event_attendance(event)
+        description = '{}\n\n{}'.format(event.get('Description') or '', '\n'.join(
+            '{} ({}): {}'.format(status, len(names), ', '.join(names)) for status, names in attendance.items()))
+        yield 'BEGIN:VEVENT\r\n'
+        yield ics_fold('UID:{}@eventbot'.format(event['_id']))
+        yield 'DTSTAMP:{}\r\n'.format(stamp)
+        yield 'DTSTART:{}\r\n'.format(event['Time'].astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ'))
+        yield ics_fold('SUMMARY:' + ics_escape(event['Name']))
+        yield ics_fold('DESCRIPTION:' + ics_escape(description.strip()))
+        yield 'END:VEVENT\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+# file f: binary file to write the export to
+# Returns number of bytes written
+def write_export(f, guild_id, fmt='ics', start=None, end=None):
+    written = 0
+    for piece in iter_export(guild_id, fmt, start, end):
+        written += f.write(piece.encode('utf-8'))
+    return written
+
+
+# ==== Helper Functions: Recurring events ====
+# A recurring event is one rule in RULES: {'GuildID', 'Name', 'Author', 'Description',
+# 'Days': weekdays (0 is Monday), 'Hour', 'Minute', 'Timezone', 'Start', 'Materialized'}.
+# Its occurrences are normal events named "[name] [m/d]", created only once they are
+# within RECURRING_LOOKAHEAD_DAYS, or when someone shows one further ahead.
+# 'Materialized' is the time up to which occurrences have been created.
+# 'Skipped' lists start times of occurrences which were unscheduled or rescheduled, so they
+# are not created again and other events can use their time.
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+OCCURRENCE_NAME = re.compile(r'^(?P<name>.+) (?P<month>\d{1,2})/(?P<day>\d{1,2})$')
+
+# string guild_id -> list of rules. Rules only change through this bot, so they are
+# cached until they do.
+RULES_CACHE = {}
+
+# int/string guild_id: guild to get recurring event rules of
+def get_rules(guild_id):
+    guild_id = str(guild_id)
+    if not guild_id.isdigit():
+        return [] # not a guild's collection
+    rules = RULES_CACHE.get(guild_id)
+    if rules is None:
+        rules = RULES_CACHE[guild_id] = list(RULES.find({'GuildID': int(guild_id)}).sort('Name', ASCENDING))
+    return rules
+
+# string days: weekdays separated by commas or slashes, e.g. "tue,thu" or "Tue/Thu"
+# Returns sorted list of weekday numbers, or None if a day is not recognized
+def parse_days(days):
+    numbers = set()
+    for day in re.split(r'[,/ ]+', days.strip().lower()):
+        if day[:3] not in DAY_NAMES:
+            return None
+        numbers.add(DAY_NAMES.index(day[:3]))
+    return sorted(numbers)
+
+# rule: recurring event rule
+# date date: day of the occurrence
+# Returns start time of the rule's occurrence on date
+def occurrence_time(rule, date):
+    tz = pytz.timezone(rule['Timezone'])
+    return tz.localize(datetime.datetime.combine(date, datetime.time(rule['Hour'], rule['Minute'])))
+
+# rule: recurring event rule
+# datetime time: time to check
+# Returns True if one of the rule's occurrences starts at time
+def rule_occurs_at(rule, time):
+    local = time.astimezone(pytz.timezone(rule['Timezone']))
+    return (local.weekday() in rule['Days'] and (local.hour, local.minute) == (rule['Hour'], rule['Minute'])
+            and local.second == 0 and time >= rule['Start'] and time not in rule.get('Skipped', []))
+
+# rule: recurring event rule
+# datetime start, end: only occurrences starting in [start, end) are returned
+# Returns list of (name, time) of the rule's occurrences
+def rule_occurrences(rule, start, end):
+    start = max(start, rule['Start'])
+    tz = pytz.timezone(rule['Timezone'])
+    date = start.astimezone(tz).date()
+    occurrences = []
+    while date <= end.astimezone(tz).date():
+        if date.weekday() in rule['Days']:
+            time = occurrence_time(rule, date)
+            if start <= time < end and time not in rule.get('Skipped', []):
+                occurrences.append(('{} {}/{}'.format(rule['Name'], date.month, date.day), time))
+        date += datetime.timedelta(days=1)
+    return occurrences
+
+# rule: recurring event rule
+# list occurrences: (name, time) of occurrences to create
+# Creates the occurrences which do not exist yet, with one query and one insert
+def create_occurrences(rule, occurrences):
+    if not occurrences:
+        return
+    collection = get_collection(rule['GuildID'])
+    names = [name for name, _ in occurrences]
+    existing = {event['Name'] for event in collection.find({'Name': {'$in': names}}, {'Name': 1})}
+    events = []
+    for name, time in occurrences:
+        if name not in existing:
+            event = make_event(name, rule['Author'], time, rule['Description'], rule['GuildID'])
+            event['Metadata']['Rule'] = rule['_id']
+            events.append(event)
+    if events:
+        try:
+            collection.insert_many(events, ordered=False)
+        except BulkWriteError:
+            pass # created at the same time by another caller
+
+# rule: recurring event rule
+# Create occurrences of rule up to RECURRING_LOOKAHEAD_DAYS ahead
+def materialize_rule(rule):
+    present = datetime.datetime.now(DEFAULT_TZ)
+    until = present + datetime.timedelta(days=RECURRING_LOOKAHEAD_DAYS)
+    start = max(present, rule.get('Materialized') or present)
+    create_occurrences(rule, rule_occurrences(rule, start, until))
+    RULES.update_one({'_id': rule['_id']}, {'$set': {'Materialized': until}, '$pull': {'Skipped': {'$lt': present}}})
+    rule['Materialized'] = until
+    rule['Skipped'] = [time for time in rule.get('Skipped', []) if time >= present]
+
+# Create upcoming occurrences of every guild's recurring events
+def materialize_all_rules():
+    for rule in RULES.find({}):
+        materialize_rule(rule)
+    RULES_CACHE.clear() # Materialized changed
+
+# event: event entry in mongodb with Time and Metadata.Rule, which is being deleted or moved
+# If event is an occurrence of a recurring event, records that the occurrence does not
+# happen at its time any more, see 'Skipped'
+def skip_occurrence(event, collection):
+    rule_id = event.get('Metadata', {}).get('Rule')
+    if rule_id is None:
+        return
+    RULES.update_one({'_id': rule_id}, {'$addToSet': {'Skipped': event['Time']}})
+    RULES_CACHE.pop(str(collection.name), None)
+
+# string name: name of an event which does not exist
+# Creates the event if it is an occurrence of a recurring event further ahead than
+# RECURRING_LOOKAHEAD_DAYS. Returns the event, or None if name is no occurrence.
+def materialize_occurrence(name, collection):
+    match = OCCURRENCE_NAME.match(name)
+    if match is None:
+        return None
+    rules = [rule for rule in get_rules(collection.name) if rule['Name'] == match.group('name')]
+    if not rules:
+        return None
+    rule = rules[0]
+
+    # The next date with this month and day
+    today = datetime.datetime.now(pytz.timezone(rule['Timezone'])).date()
+    try:
+        date = datetime.date(today.year, int(match.group('month')), int(match.group('day')))
+        if date < today:
+            date = date.replace(year=today.year + 1)
+    except ValueError:
+        return None
+    time = occurrence_time(rule, date)
+    if not rule_occurs_at(rule, time):
+        return None
+
+    create_occurrences(rule, [(name, time)])
+    return find_event(name, collection)
+
+# string name: name of event to search for
+# Like find_event, but also finds occurrences of recurring events which were not created yet
+def find_or_materialize_event(name, collection, projection=None):
+    return find_event(name, collection, projection) or materialize_occurrence(name, collection)
+
+# ctx: context of the command creating the rule
+# list days: weekday numbers, see parse_days
+# string time: time of day, e.g. 8pm or 20:00
+# Returns message to send
+def new_rule(ctx, name, days, time, description='No description.'):
+    guild_id = ctx.message.guild.id
+    tz = get_timezone(guild_id)
+    today = datetime.datetime.now(tz).date()
+    start = fast_parse_datetime(time, today)
+    if start is None:
+        return "Cannot read time {}. Use a time like 8pm or 20:00.".format(time)
+    if any(rule['Name'] == name for rule in get_rules(guild_id)):
+        return name + " already exists in recurring events."
+
+    rule = {'GuildID': guild_id, 'Name': name, 'Author': user_to_username(ctx.message.author),
+            'Description': description, 'Days': days, 'Hour': start.hour, 'Minute': start.minute,
+            'Timezone': tz.zone, 'Start': tz.localize(datetime.datetime.combine(today, datetime.time())),
+            'Materialized': None, 'Skipped': []}
+    present = datetime.datetime.now(tz)
+    collection = get_collection(guild_id)
+    upcoming = rule_occurrences(rule, present, present + datetime.timedelta(days=RECURRING_LOOKAHEAD_DAYS))
+    clashes = [occurrence for occurrence, at in upcoming if time_exists(at, collection)]
+    if clashes:
+        return "There is already an event scheduled at the time of {}.".format(clashes[0])
+
+    RULES.insert_one(rule)
+    RULES_CACHE.pop(str(guild_id), None)
+    materialize_rule(rule)
+    example = upcoming[0][0] if upcoming else name + ' [mm/dd]'
+    return "Scheduled **{}**: {}.\nEach occurrence is named like `{}`.".format(name, pprint_rule(rule), example)
+
+# string name: name of recurring event to stop
+# Returns message to send. Occurrences which were already created are kept.
+def delete_rule(ctx, name):
+    guild_id = ctx.message.guild.id
+    result = RULES.delete_one({'GuildID': guild_id, 'Name': name})
+    RULES_CACHE.pop(str(guild_id), None)
+    if not result.deleted_count:
+        return pprint_event_not_found(name)
+    return "Stopped recurring event {}. Occurrences already scheduled are kept.".format(name)
+
+# rule: recurring event rule
+def pprint_rule(rule):
+    sample = occurrence_time(rule, datetime.date.today())
+    return "{} - every {} at {}".format(rule['Name'], ', '.join(DAY_NAMES[day].title() for day in rule['Days']),
+                                       sample.strftime('%-I:%M%p %Z'))
+
+
+# ==== Helper Functions: Event messages ====
+# Messages the bot sent showing an event, so reactions can be matched to their event
+# without fetching the message. Kept in memory and persisted in MESSAGES.
+
+# int message id -> (guild id as string, event _id)
+EVENT_MESSAGES = {}
+# string event _id -> set of message ids
+EVENT_MESSAGE_IDS = collections.defaultdict(set)
+EVENT_MESSAGES_LOCK = threading.Lock()
+# Set once load_event_messages has run, reactions wait for it before being applied
+EVENT_MESSAGES_LOADED = asyncio.Event()
+# int message id -> None, messages found not to show an event, least recently seen first
+NON_EVENT_MESSAGES = collections.OrderedDict()
+
+# int message_id: id of message showing the event
+# int guild_id: guild the event belongs to
+# ObjectId event_id: _id of event shown
+def register_event_message(message_id, guild_id, event_id):
+    with EVENT_MESSAGES_LOCK:
+        EVENT_MESSAGES[message_id] = (str(guild_id), event_id)
+        EVENT_MESSAGE_IDS[str(event_id)].add(message_id)
+    MESSAGES.replace_one({'_id': message_id}, {'_id': message_id, 'Event': event_id, 'GuildID': int(guild_id)}, upsert=True)
+
+# list event_ids: _ids of deleted events whose messages to forget
+def forget_event_messages(event_ids):
+    forgotten = []
+    with EVENT_MESSAGES_LOCK:
+        for event_id in event_ids:
+            message_ids = EVENT_MESSAGE_IDS.pop(str(event_id), set())
+            for message_id in message_ids:
+                EVENT_MESSAGES.pop(message_id, None)
+            if message_ids:
+                forgotten.append(event_id)
+    if forgotten:
+        MESSAGES.delete_many({'Event': {'$in': forgotten}})
+
+# Load the messages sent by previous runs. Only needs to run once at startup.
+def load_event_messages():
+    for doc in MESSAGES.find({}):
+        with EVENT_MESSAGES_LOCK:
+            EVENT_MESSAGES[doc['_id']] = (str(doc['GuildID']), doc['Event'])
+            EVENT_MESSAGE_IDS[str(doc['Event'])].add(doc['_id'])
+    info("Loaded {} event messages.".format(len(EVENT_MESSAGES)))
+    bot.loop.call_soon_threadsafe(EVENT_MESSAGES_LOADED.set)
+
+# Message message: message reacted to which is not in EVENT_MESSAGES
+# Event messages sent before messages were registered are recognised by their text,
+# as reactions were before, and registered so this only happens once per message.
+# Returns _id of the event the message shows, or None if it does not show one
+def register_legacy_message(message, guild_id):
+    if "by react" not in message.content:
+        return None
+    event_name = message.content.splitlines()[0].strip('_*')
+    event = find_event(event_name, get_collection(guild_id), {'_id': 1})
+    if event is None:
+        return None
+    register_event_message(message.id, guild_id, event['_id'])
+    return event['_id']
+
+# int message_id: message which does not show an event
+def forget_non_event_message(message_id):
+    NON_EVENT_MESSAGES[message_id] = None
+    NON_EVENT_MESSAGES.move_to_end(message_id)
+    while len(NON_EVENT_MESSAGES) > NON_EVENT_MESSAGES_SIZE:
+        NON_EVENT_MESSAGES.popitem(last=False)
 
 
 # ==== Discord specific helpers ====
@@ -586,29 +2726,179 @@ async def send_temp_message(ctx, msg):
 # Remove default help command
 bot.remove_command('help')
 
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started = monotonic()
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    observe('eventbot_command_seconds', {'command': ctx.command.name}, monotonic() - ctx.command_started)
+
+@bot.event
+async def on_command_error(ctx, exception):
+    if ctx.command is not None:
+        increment('eventbot_command_errors_total', {'command': ctx.command.name})
+    # Default handling: print the error to the console
+    await commands.Bot.on_command_error(bot, ctx, exception)
+
 
 # ==== Background tasks ====
 
 async def send_reminders():
     await bot.wait_until_ready()
 
+    await run_db(load_reminders)
+
+    while 1:
+        REMINDER_WAKEUP.clear()
+        try:
+            await dispatch_reminders(pop_due_reminders())
+        except Exception:
+            logging.exception("Failed to dispatch reminders")
+
+        # Sleep until the next reminder is due or a new earlier one is scheduled
+        delay = seconds_until_next_reminder()
+        if delay is None or delay > REMINDER_CYCLE:
+            delay = REMINDER_CYCLE
+        try:
+            await asyncio.wait_for(REMINDER_WAKEUP.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def materialize_rules():
+    await bot.wait_until_ready()
+    while 1:
+        try:
+            await run_db(materialize_all_rules)
+        except Exception:
+            logging.exception("Failed to create occurrences of recurring events")
+        await asyncio.sleep(RECURRING_CHECK_CYCLE)
+
+async def prune_events():
+    await bot.wait_until_ready()
     while 1:
-        for name in db.collection_names():
-            if not name.isdigit():
-                continue
-            collection = get_collection(name)
-            cursor = collection.find({})
-            for event in cursor:
-                reminders = event['Metadata']['Reminders']
-                for user_name in list(event['Metadata']['Reminders'].keys()):
-                    present = datetime.datetime.now(DEFAULT_TZ)
-                    if present + datetime.timedelta(minutes=reminders[user_name]) >= event['Time']:
-                        info("Sending reminder: {} {}".format(event['Name'], reminders))
-                        event_name = event["Name"]
-                        user = username_to_user(bot, user_name)
-                        await user.send("Hey! Your event {} is starting within {} minutes!".format(event['Name'], reminders[user_name]))
-                        delete_reminder(event, user_name, collection)
-        await asyncio.sleep(REMINDER_CYCLE)
+        try:
+            await run_db(prune_stale_events)
+        except Exception:
+            logging.exception("Failed to prune stale events")
+        await asyncio.sleep(STALE_CHECK_CYCLE)
+
+
+# Write buffered changes every WRITE_FLUSH_INTERVAL, or when buffer_write finds the buffer full
+async def flush_write_buffer():
+    while 1:
+        try:
+            await asyncio.wait_for(WRITE_WAKEUP.wait(), timeout=WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        WRITE_WAKEUP.clear()
+        try:
+            await run_db(flush_writes)
+        except Exception:
+            logging.exception("Failed to flush buffered writes")
+
+# Measure how late the event loop wakes up sleeping tasks. Anything above a few
+# milliseconds means a coroutine is blocking it.
+async def monitor_loop_lag():
+    while 1:
+        start = monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = monotonic() - start - LOOP_LAG_INTERVAL
+        LOOP_LAG['last'] = lag
+        observe('eventbot_loop_lag_seconds', {}, lag)
+
+LOOP_LAG = {'last': 0.0}
+
+
+# list due: (guild_id, event_id, user_key) of reminders to send
+@timed('eventbot_handler_seconds', handler='dispatch_reminders')
+async def dispatch_reminders(due):
+    if not due:
+        return
+    try:
+        events = await run_db(find_reminder_events, due)
+    except Exception:
+        requeue_reminders(due)
+        raise
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    jobs = []
+    for guild_id, event_id, user_key in due:
+        event = events.get((guild_id, event_id))
+        if event is None or user_key not in event['Metadata']['Reminders']:
+            continue # event deleted or reminder removed since it was scheduled
+        jobs.append(((guild_id, event_id, user_key), event))
+
+    async def send(key, event):
+        if key in SENT_REMINDERS:
+            return None # sent by an earlier dispatch which could not acknowledge it
+        return await send_reminder(semaphore, key[2], event)
+    errors = await asyncio.gather(*[send(key, event) for key, event in jobs])
+
+    now = datetime.datetime.now(DEFAULT_TZ)
+    failures = [{'GuildID': int(guild_id), 'Event': event_id, 'Name': event['Name'], 'User': user_key, 'Error': error, 'Time': now}
+                for ((guild_id, event_id, user_key), event), error in zip(jobs, errors) if error]
+    keys = [key for key, _ in jobs]
+    try:
+        await run_db(acknowledge_reminders, keys, failures)
+    except Exception:
+        # Still stored, so try acknowledging again later without sending them twice
+        SENT_REMINDERS.update(keys)
+        requeue_reminders(keys)
+        raise
+    SENT_REMINDERS.difference_update(keys)
+    increment('eventbot_reminders_total', {'result': 'sent'}, len(jobs) - len(failures))
+    increment('eventbot_reminders_total', {'result': 'failed'}, len(failures))
+    info("Sent {} reminders, {} failed.".format(len(jobs) - len(failures), len(failures)))
+
+# (guild_id, event_id, user_key) of reminders which were handled but could not be acknowledged
+SENT_REMINDERS = set()
+
+# list due: (guild_id, event_id, user_key) of reminders popped by pop_due_reminders whose
+#           dispatch failed
+# Puts them back in the schedule, due in REMINDER_REQUEUE_DELAY seconds, unless they
+# were scheduled again in the meantime
+def requeue_reminders(due):
+    retry_time = datetime.datetime.now(DEFAULT_TZ) + datetime.timedelta(seconds=REMINDER_REQUEUE_DELAY)
+    with REMINDER_LOCK:
+        for guild_id, event_id, user_key in due:
+            if user_key not in REMINDER_INDEX.get((guild_id, event_id), {}):
+                schedule_reminder(guild_id, event_id, user_key, retry_time)
+
+# Semaphore semaphore: limits reminder DMs sent at the same time
+# string user_key: key of reminder to send, see set_reminder
+# event: event entry in mongodb with Name and Metadata.Reminders
+# Returns None if the reminder was sent, otherwise a description of why it could not be
+async def send_reminder(semaphore, user_key, event):
+    minutes = reminder_minutes(event['Metadata']['Reminders'][user_key])
+    msg = "Hey! Your event {} is starting within {} minutes!".format(event['Name'], minutes)
+    delay = REMINDER_RETRY_DELAY
+
+    for attempt in range(1, REMINDER_ATTEMPTS + 1):
+        try:
+            async with semaphore:
+                user = await reminder_user(user_key)
+                if user is None:
+                    return 'User not found'
+                await user.send(msg)
+            info("Sent reminder for {} to {}".format(event['Name'], user_key))
+            return None
+        except discord.HTTPException as e:
+            # Rate limits and errors on discord's side may pass, anything else will not
+            if e.status != 429 and e.status < 500:
+                warning("Could not remind {} of {}: {}".format(user_key, event['Name'], e))
+                return '{} {}'.format(e.status, e.text)
+            error = '{} {}'.format(e.status, e.text)
+        except (OSError, asyncio.TimeoutError) as e:
+            error = repr(e)
+
+        if attempt < REMINDER_ATTEMPTS:
+            warning("Retrying reminder for {} to {} in {}s: {}".format(event['Name'], user_key, delay, error))
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    warning("Gave up reminding {} of {}: {}".format(user_key, event['Name'], error))
+    return error
 
 
 # ==== Events ====
@@ -621,38 +2911,144 @@ async def on_ready():
     info("Current time: {}".format(pprint_time(datetime.datetime.now(DEFAULT_TZ))))
     info("Currently active on servers:\n{}".format('\n'.join([guild.name for guild in bot.guilds])))
     print('-------------------')
-
+    if 'ready' not in STARTUP_TIMES: # on_ready runs again after reconnecting
+        STARTUP_TIMES['ready'] = monotonic() - STARTUP_START
+        bot.loop.create_task(warm_up())
+
+# Seconds taken by each step of starting up, see warm_up. import is from STARTUP_START to the
+# end of this module and ready from STARTUP_START to the first on_ready, so it includes the others
+# before it; db_connect, db_load and warm_up are the time spent in each.
+STARTUP_TIMES = {}
+
+# Setup which is not needed to log in. With LAZY_STARTUP this runs in the background
+# after on_ready, otherwise it runs at import and on_ready only logs the report.
+async def warm_up():
+    if 'db_connect' not in STARTUP_TIMES:
+        await run_db(warm_up_db)
+    if not LAZY_STARTUP:
+        pprint_startup_report()
+        return
+    start = monotonic()
+    await run_db(warm_up_helpers)
+    STARTUP_TIMES['warm_up'] = monotonic() - start
+    pprint_startup_report()
+
+# Connect to the database and load what the bot keeps in memory
+def warm_up_db():
+    start = monotonic()
+    db.command('ping')
+    STARTUP_TIMES['db_connect'] = monotonic() - start
+    ensure_all_indexes()
+    load_event_messages()
+    STARTUP_TIMES['db_load'] = monotonic() - start - STARTUP_TIMES['db_connect']
+
+# Load things which would otherwise slow down the first command that needs them
+def warm_up_helpers():
+    valid_timezones()
+    us_timezones()
+    import dateparser
+
+def pprint_startup_report():
+    steps = ['import', 'db_connect', 'db_load', 'ready', 'warm_up']
+    report = ', '.join('{} {:.2f}s'.format(step, STARTUP_TIMES[step]) for step in steps if step in STARTUP_TIMES)
+    info("Startup times: {}".format(report))
+    return report
+
+
+# message id -> reaction payloads waiting to be applied to that message
+PENDING_REACTIONS = {}
 
 @bot.event
+@timed('eventbot_handler_seconds', handler='on_raw_reaction_add')
 async def on_raw_reaction_add(payload):
-    guild = bot.get_guild(payload.guild_id)
-    channel = guild.get_channel(payload.channel_id)
-    user = bot.get_user(payload.user_id)
-    message = await channel.get_message(payload.message_id)
-    reaction = message.reactions[0]
-    timezone = get_timezone(guild.id)
-    collection = get_collection(payload.guild_id)
-
-    listen_to_reactions = "by react" in message.content
-
-    if listen_to_reactions:
-        status = emoji_to_status(reaction.emoji)
-        event_name = message.content.splitlines()[0].strip('_*')
-        info("{} reacted {} to {}".format(user.name, reaction, event_name))
-
-        if reaction.emoji == REMINDER_EMOJI:
-            set_reminder(event_name, user, collection=collection)
-            await user.send("Got it! You should get a reminder for {} {} minutes before it starts.".format(event_name, REMINDER_TIME))
+    if payload.message_id in NON_EVENT_MESSAGES or payload.user_id == bot.user.id:
+        return
+    if payload.message_id in PENDING_REACTIONS:
+        PENDING_REACTIONS[payload.message_id].append(payload)
+        return
+
+    PENDING_REACTIONS[payload.message_id] = [payload]
+    bot.loop.create_task(process_reactions(payload.guild_id, payload.channel_id, payload.message_id))
+
+# Apply reactions to one message in batches until no more arrive. Only one of these
+# runs per message, so edits to the message never race each other.
+async def process_reactions(guild_id, channel_id, message_id):
+    # Until then a message missing from EVENT_MESSAGES may just not be loaded yet
+    await EVENT_MESSAGES_LOADED.wait()
+    while 1:
+        await asyncio.sleep(REACTION_BATCH_WINDOW)
+        payloads = PENDING_REACTIONS[message_id]
+        PENDING_REACTIONS[message_id] = []
+        try:
+            await apply_reactions(guild_id, channel_id, message_id, payloads)
+        except Exception:
+            logging.exception("Failed to apply {} reactions to message {}".format(len(payloads), message_id))
+
+        if not PENDING_REACTIONS[message_id]:
+            del PENDING_REACTIONS[message_id]
+            return
+
+# list payloads: reactions added to message_id since it was last updated
+@timed('eventbot_handler_seconds', handler='apply_reactions')
+async def apply_reactions(guild_id, channel_id, message_id, payloads):
+    guild = bot.get_guild(guild_id)
+    channel = guild.get_channel(channel_id)
+    message = await channel.get_message(message_id)
+    collection = get_collection(guild_id)
+    if message_id in EVENT_MESSAGES:
+        event_id = EVENT_MESSAGES[message_id][1]
+    else:
+        event_id = await run_db(register_legacy_message, message, guild_id)
+        if event_id is None:
+            forget_non_event_message(message_id)
+            return
+
+    event = None
+    attendance = collections.OrderedDict() # user id -> (User, status), latest reaction of each user wins
+    reminder_users = []
+    invalid = False
+
+    for payload in payloads:
+        user = bot.get_user(payload.user_id)
+        if user is None:
+            continue
+        emoji = str(payload.emoji)
+        status = emoji_to_status(emoji)
+        info("{} reacted {} to message {}".format(user.name, emoji, message_id))
+
+        if emoji == REMINDER_EMOJI:
+            reminder_users.append(user)
         elif not status:
-            msg = '**Not a valid reaction option.** Please try again using one of the specified emojis.'
-            err_message = await channel.send(msg)
-            await err_message.edit(content=msg, delete_after=TEMP_MESSAGE_DURATION)
-        else:  
-            set_attendance(event_name, user, status, collection)
-            new_message = pprint_event(event_name, collection=collection) + pprint_attendance_instructions()
+            invalid = True
+        else:
+            attendance.pop(user.id, None)
+            attendance[user.id] = (user, status)
+
+    if attendance:
+        event, write_seq = await run_db(set_attendance_bulk, event_id, list(attendance.values()), collection)
+        if event:
+            new_message = await run_db(pprint_event, event['Name'], collection=collection, event=event, write_seq=write_seq)
+            new_message += pprint_attendance_instructions()
             await message.edit(content=new_message)
 
-        await message.clear_reactions()
+    await message.clear_reactions()
+
+    if reminder_users and event is None:
+        event = await run_db(collection.find_one, {'_id': event_id}, {'Name': 1, 'Time': 1, 'Metadata': 1})
+    if event is None:
+        reminder_users = []
+
+    for user in reminder_users:
+        await run_db(set_reminder, event['Name'], user, collection=collection, event=event)
+        try:
+            await user.send("Got it! You should get a reminder for {} {} minutes before it starts.".format(event['Name'], REMINDER_TIME))
+        except discord.HTTPException as e:
+            warning("Could not confirm reminder to {}: {}".format(user.name, e))
+
+    if invalid:
+        msg = '**Not a valid reaction option.** Please try again using one of the specified emojis.'
+        err_message = await channel.send(msg)
+        await err_message.edit(content=msg, delete_after=TEMP_MESSAGE_DURATION)
 
 
 # ==== Config Commands ====
@@ -660,12 +3056,12 @@ async def on_raw_reaction_add(payload):
 async def timezone(ctx, timezone):
     guild_name = ctx.message.guild.name
     guild_id = ctx.message.guild.id
-    if set_timezone(guild_id, timezone):
-        new_timezone = get_timezone(guild_id)
+    if await run_db(set_timezone, guild_id, timezone):
+        new_timezone = await run_db(get_timezone, guild_id)
         msg = "Set timezone for {} ({}) to {}.".format(guild_name, guild_id, new_timezone)
         await ctx.send(msg)
     else:
-        msg = "**Valid timezones:** \n`{}`".format(', '.join(US_TZ))
+        msg = "**Valid timezones:** \n`{}`".format(', '.join(us_timezones()))
         await ctx.send(msg)
 
 
@@ -678,45 +3074,124 @@ async def show(ctx, *, name):
     name = name.strip('\"')
     guild_id = ctx.message.guild.id
     collection = get_collection(guild_id)
-    timezone = get_timezone(guild_id)
+    write_seq = render_write_seq()
+    event = await run_db(find_or_materialize_event, name, collection)
 
-    if event_exists(name, collection):
-        msg = pprint_event(name, collection=collection)
+    if event:
+        msg = await run_db(pprint_event, name, collection=collection, event=event, write_seq=write_seq)
         msg += pprint_attendance_instructions()
     else:
         msg = pprint_event_not_found(name)
 
-    await ctx.send(msg)
+    message = await ctx.send(msg)
+    if event:
+        await run_db(register_event_message, message.id, guild_id, event['_id'])
 
 @bot.command(aliases=["sa"])
-async def show_all(ctx):
+async def show_all(ctx, page=1):
     log_command(ctx)
     guild_id = ctx.message.guild.id
-    msg = pprint_all_events(guild_id)
-    await ctx.send(msg)
+    messages = await run_db(pprint_all_events, guild_id, max(page, 1))
+    for msg in messages:
+        await ctx.send(msg)
 
 @bot.command(aliases=["sched", "sch"])
 async def schedule(ctx, name, date, time, description='No description.'):
     log_command(ctx)
     datetime = date + ' ' + time
-    msg = new_event(ctx, name, datetime, description)
+    msg, event = await run_db(new_event, ctx, name, datetime, description)
+    message = await ctx.send(msg)
+    if event:
+        await run_db(register_event_message, message.id, ctx.message.guild.id, event['_id'])
+
+@bot.command()
+async def export(ctx, fmt='ics', start=None, end=None):
+    log_command(ctx)
+    fmt = fmt.lower()
+    if fmt not in ('ics', 'json'):
+        await send_temp_message(ctx, "Export format must be ics or json.")
+        return
+
+    guild_id = ctx.message.guild.id
+    tz = await run_db(get_timezone, guild_id)
+    try:
+        start = start and await run_db(input_to_datetime, start, tz)
+        end = end and await run_db(input_to_datetime, end, tz)
+    except Exception:
+        start = end = False
+    if start is False or end is False:
+        await send_temp_message(ctx, "Cannot read the dates. Use dates like 3/14 or 3/14 8pm.")
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as f:
+        await run_db(write_export, f, guild_id, fmt, start, end)
+        f.seek(0)
+        filename = 'events.ics' if fmt == 'ics' else 'events.jsonl'
+        await ctx.send(file=discord.File(f, filename))
+
+@bot.command(aliases=["sw"])
+async def schedule_weekly(ctx, name, days, time, description='No description.'):
+    log_command(ctx)
+    day_numbers = parse_days(days)
+    if not day_numbers:
+        await send_temp_message(ctx, "Cannot read days {}. Use days like tue,thu.".format(days))
+        return
+    msg = await run_db(new_rule, ctx, name, day_numbers, time, description)
     await ctx.send(msg)
 
+@bot.command(aliases=["usw"])
+async def unschedule_weekly(ctx, *, name):
+    log_command(ctx)
+    name = name.strip('\"')
+    if not await run_db(is_admin, ctx):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+    msg = await run_db(delete_rule, ctx, name)
+    await ctx.send(msg)
+
+@bot.command(aliases=["sb"])
+async def schedule_bulk(ctx):
+    log_command(ctx)
+    attachments = ctx.message.attachments
+    if not attachments:
+        await send_temp_message(ctx, "Attach a .csv or .ics file to the command message.")
+        return
+    attachment = attachments[0]
+    if attachment.size > BULK_IMPORT_MAX_BYTES:
+        await send_temp_message(ctx, "The file is too large, the limit is {} KB.".format(BULK_IMPORT_MAX_BYTES // 1024))
+        return
+
+    f = io.BytesIO()
+    await attachment.save(f)
+    f.seek(0)
+    guild_id = ctx.message.guild.id
+    tz = await run_db(get_timezone, guild_id)
+    if attachment.filename.lower().endswith('.ics'):
+        rows = read_ics_events(f, tz)
+    else:
+        rows = read_csv_events(f)
+
+    author = user_to_username(ctx.message.author)
+    created, skipped = await run_db(import_events, guild_id, author, rows, tz)
+    await ctx.send(pprint_import_summary(created, skipped))
+
 @bot.command(aliases=["resched", "rs"])
 async def reschedule(ctx, name, *, datetime):
     log_command(ctx)
     collection = get_collection(ctx.message.guild.id)
 
-    if not event_exists(name, collection=collection):
+    event = await run_db(find_event, name, collection, {'Author': 1, 'Time': 1, 'Metadata.Reminders': 1, 'Metadata.Rule': 1})
+
+    if event is None:
         msg = pprint_event_not_found(name)
         await send_temp_message(ctx, msg)
-    elif not (is_admin(ctx) or is_author(ctx, name)):
+    elif not (await run_db(is_admin, ctx) or is_author(ctx, name, event)):
         msg = pprint_insufficient_privileges()
         await send_temp_message(ctx, msg)
     else:
-        event_id = get_event_id(name, collection)
-        time = input_to_datetime(datetime, get_timezone(ctx.message.guild.id))
-        update_field(event_id, 'Time', time, collection=collection)
+        tz = await run_db(get_timezone, ctx.message.guild.id)
+        time = await run_db(input_to_datetime, datetime, tz)
+        await run_db(reschedule_event, event, time, collection)
         msg = "Set {} to {}.".format(name, pprint_time(time))
         await ctx.send(msg)
 
@@ -724,11 +3199,11 @@ async def reschedule(ctx, name, *, datetime):
 async def unschedule(ctx, *, name):
     log_command(ctx)
     collection = get_collection(ctx.message.guild.id)
+    name = name.strip('\"')
+    event = await run_db(find_event, name, collection, {'Author': 1})
 
-    if (is_admin(ctx) or is_author(ctx, name)):
-        name = name.strip('\"')
-        event = get_event(name, collection)
-        msg = delete_event(name, collection)
+    if (await run_db(is_admin, ctx) or is_author(ctx, name, event)):
+        msg = await run_db(delete_event, name, collection, event)
         await ctx.send(msg)
     else:
         msg = pprint_insufficient_privileges()
@@ -739,7 +3214,7 @@ async def unschedule_past(ctx):
     log_command(ctx)
 
     guild_id = ctx.message.guild.id
-    msg = delete_past_events(guild_id)
+    msg = await run_db(delete_past_events, guild_id)
     await ctx.send(msg)
 '''
 @bot.command()
@@ -754,9 +3229,10 @@ async def link(ctx, event_name, *, key):
 async def join(ctx, *, key):
     log_command(ctx)
 
-    collection = get_collection(ctx.message.guild.id)
-    msg = join_event(ctx, key)
-    await ctx.send(msg)
+    msg, event = await run_db(join_event, ctx, key)
+    message = await ctx.send(msg)
+    if event:
+        await run_db(register_event_message, message.id, ctx.message.guild.id, event['_id'])
 
 # User can change value of a field which is a string.
 @bot.command()
@@ -766,22 +3242,23 @@ async def edit(ctx, name, key, value):
     guild_id = ctx.message.guild.id
     collection = get_collection(guild_id)
 
-    msg = ''
-    event_id = get_event_id(name, collection)
-    event = get_event(name, collection)
+    event = await run_db(find_event, name, collection)
 
-    if not event_exists(name, collection):
-        msg += pprint_event_not_found(name) + '\n'       
+    if event is None:
+        msg = pprint_event_not_found(name)
+        await send_temp_message(ctx, msg)
+        return
 
+    admin = await run_db(is_admin, ctx)
     if (
         (key in event and not isinstance(event[key], str)) or 
-        (not (is_admin(ctx) or is_author(ctx, name))) or 
-        ((key in RESTRICTED) and not is_admin(ctx))
+        (not (admin or is_author(ctx, name, event))) or 
+        ((key in RESTRICTED) and not admin)
         ):
-        msg += "Error: the specified field cannot be changed using this command or you do not have permission."
+        msg = "Error: the specified field cannot be changed using this command or you do not have permission."
         await send_temp_message(ctx, msg)
     else:
-        update_field(event_id, key, value, collection=collection)
+        await run_db(update_field, event['_id'], key, value, collection=collection)
         msg = "Set {} to {}.".format(key, value)
         await ctx.send(msg)
 
@@ -801,6 +3278,22 @@ async def help(ctx):
         Aliases: `!sched, !sch`''', 
         inline=False)
 
+    embed.add_field(
+        name="!schedule_weekly [name] [days] [time] [description]", 
+        value='''Create an event which repeats every week, e.g. practice.
+        Each occurrence is a separate event named after its date, created a week ahead.
+        Example: `!schedule_weekly Practice tue,thu 8pm`
+        Stop it with `!unschedule_weekly [name]` (admins only).
+        Aliases: `!sw`''', 
+        inline=False)
+
+    embed.add_field(
+        name="!schedule_bulk (with a .csv or .ics file attached)", 
+        value='''Create many events at once. CSV rows are name, date, time, description.
+        Example row: `Scrim against SHD,3/14,1:00PM,Descriptive description.`
+        Aliases: `!sb`''', 
+        inline=False)
+
     embed.add_field(
         name="!reschedule [name] [datetime] ", 
         value='''Edit the time of an existing event.  
@@ -823,9 +3316,10 @@ async def help(ctx):
         inline=False)
 
     embed.add_field(
-        name="!show_all", 
-        value='''Show name and time for all upcoming events.
-        Aliases: `!sa`''', 
+        name="!show_all [page]", 
+        value='''Show name and time for all upcoming events, earliest first.
+        Events are listed {} at a time, use the page number to see more.
+        Aliases: `!sa`'''.format(EVENTS_PER_PAGE), 
         inline=False)
 
     embed.add_field(
@@ -842,6 +3336,12 @@ async def help(ctx):
         `Example: !edit "Scrim against SHD" "Description" "Improved description."`''', 
         inline=False)
 
+    embed.add_field(
+        name="!export [ics or json] [from] [to]", 
+        value='''Send this server's events as a file, to import into a calendar.
+        From and to are optional dates, e.g. `!export ics 3/1 4/1`.''', 
+        inline=False)
+
     embed.add_field(
         name="!timezone [timezone]", 
         value='''Set timezone for current server. Valid values include:
@@ -867,7 +3367,11 @@ async def help(ctx):
 @bot.command()
 async def set_attend(ctx, event_name, user_name, status):
     if is_admin(ctx):
-        msg = set_attendance(event_name, user_name, status)
+        collection = get_collection(ctx.message.guild.id)
+        if set_attendance(event_name, user_name, status, collection):
+            msg = "Set **{}'s** status to **{}** for **{}**.".format(user_name, status, event_name)
+        else:
+            msg = pprint_event_not_found(event_name)
         await ctx.send(msg)'''
 
 @bot.command()
@@ -879,20 +3383,17 @@ async def factory(ctx, num_events=5):
         date = '10/{}'.format(num+1)
         time = str(1 + num) + ':00pm'
         name = '-test' + str(num)
-        msg = new_event(ctx, name, datetime)
-        await ctx.send(msg)
+        msg, event = await run_db(new_event, ctx, name, date + ' ' + time)
+        message = await ctx.send(msg)
+        if event:
+            await run_db(register_event_message, message.id, ctx.message.guild.id, event['_id'])
         info("Factory creating event on date {} at time {}".format(date, time))
 
     await ctx.send("Attempted to create {} test events".format(num_events))
 
 @bot.command()
 async def teardown(ctx):
-    collection = get_collection(ctx.message.guild.id)
-
-    cursor = collection.find({})
-    for event in cursor:
-        if event['Name'].startswith('-test'):
-            delete_event(event['Name'], collection)
+    await run_db(delete_test_events, ctx.message.guild.id)
     await ctx.send('Deleted test events.')
 
 @bot.command()
@@ -904,10 +3405,82 @@ async def dump_roles(ctx):
         print(role.name, ' - position', role.position)
     await ctx.send('Logged roles in console.')
 
+@bot.command(name='migrate_storage')
+async def migrate_storage_command(ctx, restart=''):
+    if not await bot.is_owner(ctx.message.author):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+
+    await ctx.send('Copying guild collections into the shared events collection...')
+    copied, removed = await run_db(migrate_storage, restart == 'restart')
+    await ctx.send('Copied {} events from {} guild collections, deleted {} copies of deleted events.'.format(
+        sum(copied.values()), len(copied), removed))
+
+@bot.command(name='migrate_user_ids')
+async def migrate_user_ids_command(ctx):
+    if not await bot.is_owner(ctx.message.author):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+
+    updated, unmatched = await run_db(migrate_user_ids)
+    await ctx.send('Stored user ids in {} events. {} names did not match any user.'.format(updated, unmatched))
+
+@bot.command()
+async def stats(ctx):
+    if not await run_db(is_admin, ctx):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+    await ctx.send('```{}```'.format(pprint_stats()))
+
+@bot.command(name='profile')
+async def profile_command(ctx, seconds=10.0):
+    if not await run_db(is_admin, ctx):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    await ctx.send('Profiling for {} seconds...'.format(seconds))
+    # Not on DB_EXECUTOR, so the profiler does not take a database thread
+    report = await bot.loop.run_in_executor(None, profile, seconds)
+    data = io.BytesIO(report.encode('utf-8'))
+    await ctx.send('Collapsed stacks, one sample every {}s.'.format(PROFILE_INTERVAL), file=discord.File(data, 'profile.txt'))
+
+@bot.command()
+async def index_report(ctx):
+    # Index names and query plans are only for whoever runs the database
+    if not await bot.is_owner(ctx.message.author):
+        await send_temp_message(ctx, pprint_insufficient_privileges())
+        return
+
+    report = await run_db(pprint_index_report, ctx.message.guild.id)
+    info(report)
+    await ctx.send('```{}```'.format(report))
+
+
+# ==== Startup ====
+STARTUP_TIMES['import'] = monotonic() - STARTUP_START
+if not LAZY_STARTUP:
+    warm_up_db()
+    warm_up_helpers()
+
 
 # ==== Run ====
-bot.loop.create_task(send_reminders())
-bot.run(BOT_TOKEN)
+if __name__ == '__main__':
+    bot.loop.create_task(send_reminders())
+    bot.loop.create_task(monitor_loop_lag())
+    if EVENT_EXPIRY_HOURS:
+        bot.loop.create_task(prune_events())
+    bot.loop.create_task(materialize_rules())
+    # Also when WRITE_BEHIND was turned off since, so writes buffered before are not lost
+    replay_write_journal()
+    if WRITE_BEHIND:
+        bot.loop.create_task(flush_write_buffer())
+    start_watchdog()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    bot.run(BOT_TOKEN)
+    if WRITE_BEHIND:
+        flush_writes()
 
 
 